@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import click
+
+# Compiled (flat json) address tables, shared by the server and the clients.
+# Registers are numbered in name order, the table hash identifies the
+# numbering so both ends can check they agree before using register ids.
+
+
+def load_flat_addrtab(path):
+    """Load a {name: {'addr': hex, 'mask': hex}} table, as written by 'compile'"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def register_list(addrtab):
+    """[(name, addr, mask)] in register id order"""
+    return [(n, int(addrtab[n]['addr'], 0), int(addrtab[n]['mask'], 0)) for n in sorted(addrtab)]
+
+
+def addrtab_hash(addrtab):
+    h = hashlib.sha1()
+    for n, addr, mask in register_list(addrtab):
+        h.update(f'{n} {addr:x} {mask:x}\n'.encode())
+    return h.hexdigest()[:16]
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument('top_addrfile', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+def compile(top_addrfile, output):
+    """Flatten a uhal address table into a json table for the server"""
+    from crappyhalclient import load_addrtab
+
+    addrtab = load_addrtab(top_addrfile)
+    with open(output, 'w') as f:
+        json.dump(addrtab, f, indent=4)
+    print(f"{len(addrtab)} registers written to '{output}', hash {addrtab_hash(addrtab)}")
+
+
+@main.command()
+@click.argument('addrtab', type=click.Path(exists=True))
+def hash(addrtab):
+    """Print the hash of a json table"""
+    print(addrtab_hash(load_flat_addrtab(addrtab)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import click
+import zmq
+
+import logging
+logger = logging.getLogger(__name__)
+
+from crappyhalclient import (
+    CrappyHardwareClient, CrappyServerReplyTimeout, CrappyServerError
+)
+
+# Board info older than this is probed again
+INFO_TTL = 60
+
+
+def default_agent_path():
+    path = os.environ.get('CRAPPYAGENT_SOCKET')
+    if path:
+        return path
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), f'crappyagent-{os.getuid()}.sock')
+
+
+def agent_available(path=None):
+    return os.path.exists(path or default_agent_path())
+
+
+class CrappyAgentError(Exception):
+    "Error reported by, or while talking to, the local agent"
+    pass
+
+
+# -----------------------------------------------------------------------------
+# Agent side
+class BoardWorker(threading.Thread):
+    """Owns the connection to one board and executes the requests queued for it"""
+
+    def __init__(self, context, host, port, top_addrfile):
+        threading.Thread.__init__(self, daemon=True)
+        self.context = context
+        self.host = host
+        self.port = port
+        self.top_addrfile = top_addrfile
+        self.queue = queue.Queue()
+        self.hw = None
+        self.n_requests = 0
+        self._info = None
+        self._info_time = 0
+
+    def info(self):
+        if self._info is None or time.time()-self._info_time > INFO_TTL:
+            self._info = self.hw.board_info()
+            self._info_time = time.time()
+        return self._info
+
+    def process(self, req):
+        if self.hw is None:
+            hw = CrappyHardwareClient(self.host, self.port, self.top_addrfile)
+            # Kept only once the handshake succeeded, the next request tries again otherwise
+            hw.connect()
+            self.hw = hw
+
+        cmd = req['agent_cmd']
+        if cmd == 'attach':
+            return {'addrtab': self.hw.addrtab, 'info': self.info()}
+
+        elif cmd == 'request':
+            deadline = req.get('deadline')
+            if deadline is not None:
+                deadline = time.monotonic()+deadline
+            return {'reply': self.hw._request(req['req'], req.get('timeout'), deadline)}
+
+        raise CrappyAgentError(f"Unknown agent command '{cmd}'")
+
+    def run(self):
+        out = self.context.socket(zmq.PUSH)
+        out.connect('inproc://agent-replies')
+        while True:
+            ident, req = self.queue.get()
+            try:
+                rpl = self.process(req)
+            except Exception as e:
+                logger.error(f"{self.host}: {type(e).__name__}: {e}")
+                rpl = {'agent_error': str(e), 'type': type(e).__name__}
+            self.n_requests += 1
+            out.send_multipart([ident, b'', json.dumps(rpl).encode()])
+
+
+def serve(path):
+    context = zmq.Context()
+
+    replies = context.socket(zmq.PULL)
+    replies.bind('inproc://agent-replies')
+
+    if os.path.exists(path):
+        os.unlink(path)
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(f'ipc://{path}')
+
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
+
+    workers = {}
+    logger.info(f"crappyagent listening on {path}")
+    try:
+        while True:
+            for sock, _ in poller.poll():
+                if sock is replies:
+                    frontend.send_multipart(replies.recv_multipart())
+                    continue
+
+                frames = frontend.recv_multipart()
+                try:
+                    ident, _, message = frames
+                    req = json.loads(message)
+                    cmd = req.get('agent_cmd')
+                except (ValueError, AttributeError) as e:
+                    # A bad message must not take the agent down for every board
+                    logger.error(f"Invalid message: {type(e).__name__}: {e}")
+                    frontend.send_multipart([frames[0], b'', json.dumps(
+                        {'agent_error': 'InvalidMessage', 'type': 'CrappyAgentError'}
+                    ).encode()])
+                    continue
+
+                if cmd == 'status':
+                    rpl = {'boards': [
+                        {'host': h, 'port': p, 'addrtab': a, 'requests': w.n_requests, 'queued': w.queue.qsize()}
+                        for (h, p, a), w in workers.items()
+                    ]}
+                elif cmd == 'flush':
+                    # Board info is probed again on the next attach
+                    for w in workers.values():
+                        w._info = None
+                    rpl = {'flushed': True}
+                elif cmd == 'stop':
+                    frontend.send_multipart([ident, b'', json.dumps({'stopped': True}).encode()])
+                    return
+                elif not {'host', 'port', 'addrtab'}.issubset(req):
+                    rpl = {'agent_error': 'InvalidMessage', 'type': 'CrappyAgentError'}
+                else:
+                    key = (req['host'], req['port'], req['addrtab'])
+                    if key not in workers:
+                        workers[key] = BoardWorker(context, *key)
+                        workers[key].start()
+                    # Requests from all clients are serialized on the board connection
+                    workers[key].queue.put((ident, req))
+                    continue
+
+                frontend.send_multipart([ident, b'', json.dumps(rpl).encode()])
+    finally:
+        frontend.close(linger=0)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+# -----------------------------------------------------------------------------
+# Client side
+class CrappyAgentClient(CrappyHardwareClient):
+    """CrappyHardwareClient talking to the board through the local agent
+
+    The agent keeps the board connection, the parsed address table and the
+    board info across invocations.
+    """
+
+    def __init__(self, host, port, top_addrfile, agent_path=None):
+        self.agent_path = agent_path or default_agent_path()
+        self.agent_timeout = 30000
+        self._info = None
+        # Requests are forwarded as raw operations, the agent board connection
+        # does its own handshake and keeps _reg_ids unset here
+        CrappyHardwareClient.__init__(self, host, port, top_addrfile)
+
+    def _load_addrtab(self):
+        # Sent by the agent on attach
+        return None
+
+    def _connect_socket(self):
+        if self.context is None:
+            self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(f'ipc://{self.agent_path}')
+
+    def connect(self):
+        self._connect_socket()
+        # A stale socket left by a dead agent must not stall the caller
+        self._agent_request({'agent_cmd': 'status'}, timeout=500)
+        rpl = self._agent_request({'agent_cmd': 'attach'})
+        self._addrtab = collections.OrderedDict(rpl['addrtab'])
+        self._info = rpl['info']
+
+    def disconnect(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def _agent_request(self, req, timeout=None):
+        req.update({'host': self.host, 'port': self.port, 'addrtab': self.top_addrfile})
+        self.socket.send(json.dumps(req).encode())
+        if not self.socket.poll(self.agent_timeout if timeout is None else timeout, zmq.POLLIN):
+            # Leave the socket usable for the next request
+            self.socket.close()
+            self._connect_socket()
+            raise CrappyAgentError(f"No reply from the agent at {self.agent_path}")
+        rpl = json.loads(self.socket.recv())
+
+        if 'agent_error' in rpl:
+            if rpl.get('type') == 'CrappyServerReplyTimeout':
+                raise CrappyServerReplyTimeout(rpl['agent_error'])
+            elif rpl.get('type') == 'CrappyServerError':
+                raise CrappyServerError(rpl['agent_error'])
+            raise CrappyAgentError(rpl['agent_error'])
+        return rpl
+
+    def _request(self, req, timeout=None, deadline=None):
+        # Retries and deduplication are handled by the agent board connection
+        t0 = time.perf_counter()
+        rpl = self._agent_request({
+            'agent_cmd': 'request',
+            'req': req,
+            'timeout': timeout,
+            'deadline': None if deadline is None else deadline-time.monotonic(),
+        })
+        self.stats.add('agent', req['cmd'], time.perf_counter()-t0)
+        return rpl['reply']
+
+    def board_info(self):
+        return self._info
+
+
+def agent_command(cmd, path=None, timeout=2000):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(f'ipc://{path or default_agent_path()}')
+    try:
+        socket.send(json.dumps({'agent_cmd': cmd}).encode())
+        if not socket.poll(timeout, zmq.POLLIN):
+            raise CrappyAgentError("No reply from the agent")
+        return json.loads(socket.recv())
+    finally:
+        socket.close()
+
+
+# -----------------------------------------------------------------------------
+@click.group()
+@click.option('-s', '--socket', 'path', type=click.Path(), default=None, help='Agent socket path')
+@click.pass_context
+def main(ctx, path):
+    ctx.obj = path or default_agent_path()
+
+
+@main.command()
+@click.pass_obj
+def start(path):
+    """Run the agent in the foreground"""
+    serve(path)
+
+
+@main.command()
+@click.pass_obj
+def stop(path):
+    """Stop a running agent"""
+    agent_command('stop', path)
+
+
+@main.command()
+@click.pass_obj
+def flush(path):
+    """Forget the cached board info"""
+    agent_command('flush', path)
+
+
+@main.command()
+@click.pass_obj
+def status(path):
+    """Boards connected through the agent"""
+    from rich import print
+    from rich.table import Table
+
+    t = Table(title=f'crappyagent {path}')
+    for c in ('host', 'port', 'addrtab', 'requests', 'queued'):
+        t.add_column(c)
+    for b in agent_command('status', path)['boards']:
+        t.add_row(*(str(b[c]) for c in ('host', 'port', 'addrtab', 'requests', 'queued')))
+    print(t)
+
+
+if __name__ == '__main__':
+    import coloredlogs
+    coloredlogs.install(level='INFO', logger=logger)
+
+    main()
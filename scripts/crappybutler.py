@@ -3,16 +3,22 @@
 import click
 import os
 import socket
+import sys
 import time
-from rich import print
-from rich.table import Table
-from rich.progress import track
 
-from crappyhalclient import CrappyHardwareClient
+from crappyfmt import FORMATS, RecordWriter
+
+# rich, the hardware client and the optional tools are imported by the code
+# paths using them, keeping the start-up of commands like 'addrbook' short
 
 # -----------------------------------------------------------------------------
 # Utilities
+def print(*args, **kwargs):
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
 def dict_to_table( vals: dict, **kwargs):
+    from rich.table import Table
 
     t = Table(**kwargs)
     t.add_column('name')
@@ -22,8 +28,9 @@ def dict_to_table( vals: dict, **kwargs):
     return t
 
 def read_regs(hw, reg_list):
+    # Values split over two registers are read at once, consistently
     d = {}
-    for r in reg_list:
+    for r in hw.merge_wide(reg_list):
         v = hw.read(r)
         d[r] = v
     return d
@@ -150,39 +157,97 @@ MAX_SRCS_P_MGT =16
 mgts_all = tuple(str(i) for i in range(MAX_MGT))
 
 class CrappyObj:
-    pass
+    """Connection to the board, opened by the first command that needs it"""
+
+    def __init__(self, ctrl_id, use_agent, record, transport='auto'):
+        self.ctrl_id = ctrl_id
+        self.use_agent = use_agent
+        self.record = record
+        self.transport = transport
+        self._hw = None
+        self._info = None
+
+    def connect(self):
+        from crappyhalclient import CrappyHardwareClient
+        from crappyagent import CrappyAgentClient, CrappyAgentError, agent_available
+
+        ctrl_id = self.ctrl_id
+        addrtab = os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', ctrl_hosts[ctrl_id], 'zcu_top.xml')
+
+        hw = None
+        # An explicit transport bypasses the agent, unless asked for
+        if self.use_agent or (self.use_agent is None and self.transport == 'auto' and agent_available()):
+            try:
+                hw = CrappyAgentClient(ctrl_id, port, addrtab)
+                hw.connect()
+            except CrappyAgentError:
+                if self.use_agent:
+                    raise
+                hw = None
+
+        if hw is None:
+            hw = CrappyHardwareClient(ctrl_id, port, addrtab, self.transport)
+            # print(hw.addrtab)
+            hw.connect()
+        # Status messages go to stderr, stdout may carry records
+        print(f"Connected to '{ctrl_id}'", file=sys.stderr)
+
+        self._info = hw.board_info()
+
+        if self.record:
+            hw.start_recording()
+        self._hw = hw
+
+    def save_recording(self):
+        if self._hw is None:
+            return
+        from crappytrace import save_trace
+
+        ops = self._hw.stop_recording()
+        save_trace(self.record, ops)
+        print(f"Recorded {len(ops)} operations to '{self.record}'", file=sys.stderr)
+
+    @property
+    def hw(self):
+        if self._hw is None:
+            self.connect()
+        return self._hw
+
+    @property
+    def info(self):
+        if self._hw is None:
+            self.connect()
+        return self._info
+
+    @property
+    def n_mgt(self):
+        return self.info['n_mgt']
+
+    @property
+    def n_src(self):
+        return self.info['n_src']
+
+    @property
+    def ref_freq(self):
+        return self.info['ref_freq']
 
 @click.group(chain=True)
+@click.option('--agent/--no-agent', 'use_agent', default=None, help='Go through the local crappyagent (default: when running)')
+@click.option('--record', 'record', type=click.Path(), default=None, help='Record the operations sent to the board')
+@click.option('-t', '--transport', type=click.Choice(('auto', 'inproc', 'ipc', 'tcp')), default='auto', help='Hardware access, auto: tcp to remote boards, on the board the local server when it runs, in-process otherwise')
 @click.argument('ctrl_id', type=click.Choice(ctrl_hosts))
 @click.pass_context
-def main(ctx, ctrl_id):
-    obj = CrappyObj
-
-    addrtab = os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', ctrl_hosts[ctrl_id], 'zcu_top.xml')
-
-    obj.hw = CrappyHardwareClient(ctrl_id, port, addrtab)
-    # print(obj.hw.addrtab)
-    obj.hw.connect()
-    print(f"Connected to '{ctrl_id}'")
-    magic = obj.hw.read('tx.info.magic')
-    if magic != 0xdeadbeef:
-        raise ValueError(f"Magic number check failed. Expected '0xdeadbeef', read '{hex(magic)}'")
-
-    n_mgt = obj.hw.read('tx.info.generics.n_mgts')
-    n_src = obj.hw.read('tx.info.generics.n_srcs')
-    ref_freq = obj.hw.read('tx.info.generics.ref_freq')
-
-
-
+def main(ctx, use_agent, record, transport, ctrl_id):
+    obj = CrappyObj(ctrl_id, use_agent, record, transport)
 
-    obj.n_mgt = n_mgt
-    obj.n_src = n_src
-    obj.ref_freq = ref_freq
+    if record:
+        ctx.call_on_close(obj.save_recording)
 
     ctx.obj = obj
 
 @main.command()
 def addrbook():
+    from rich.table import Table
 
     t = Table(title="Control hosts")
     t.add_column('name')
@@ -289,29 +354,29 @@ def udp_config(obj, src_id, dst_id, link):
     dst = rx_endpoints[dst_id]
     src = tx_endpoints[src_id]
 
-    udp_core_ctrl = f'tx.udp.udp_core_{link}.udp_core_control.nz_rst_ctrl'
-    hw.write(f'{udp_core_ctrl}.filter_control', 0x07400307)
+    udp_core_ctrl = hw.node(f'tx.udp.udp_core_{link}.udp_core_control.nz_rst_ctrl')
 
     # Our IP address = 10.73.139.23
     print(f"Our ip address: {socket.inet_ntoa(src['ip'].to_bytes(4, 'big'))}")
-    hw.write(f'{udp_core_ctrl}.src_ip_addr', src['ip']) 
     # Their IP address = 10.73.139.23
     print(f"Their ip address: {socket.inet_ntoa(dst['ip'].to_bytes(4, 'big'))}")
-    hw.write(f'{udp_core_ctrl}.dst_ip_addr', dst['ip']) 
     # Our MAC address
-    # Dest MAC address
     print(f"Our mac address: 0x{src['mac']:012x}")
-    hw.write(f'{udp_core_ctrl}.src_mac_addr_lower', src['mac'] & 0xffffffff) 
-    hw.write(f'{udp_core_ctrl}.src_mac_addr_upper', (src['mac'] >> 32) & 0xffff) 
-
     # Dest MAC address
     print(f"Their mac address: 0x{dst['mac']:012x}")
-    hw.write(f'{udp_core_ctrl}.dst_mac_addr_lower', dst['mac'] & 0xffffffff) 
-    hw.write(f'{udp_core_ctrl}.dst_mac_addr_upper', (dst['mac'] >> 32) & 0xffff) 
 
-    # Ports
-    hw.write(f'{udp_core_ctrl}.udp_ports.src_port', src['port']) 
-    hw.write(f'{udp_core_ctrl}.udp_ports.dst_port', dst['port']) 
+    udp_core_ctrl.write_many({
+        'filter_control': 0x07400307,
+        'src_ip_addr': src['ip'],
+        'dst_ip_addr': dst['ip'],
+        'src_mac_addr_lower': src['mac'] & 0xffffffff,
+        'src_mac_addr_upper': (src['mac'] >> 32) & 0xffff,
+        'dst_mac_addr_lower': dst['mac'] & 0xffffffff,
+        'dst_mac_addr_upper': (dst['mac'] >> 32) & 0xffff,
+        # Ports
+        'udp_ports.src_port': src['port'],
+        'udp_ports.dst_port': dst['port'],
+    })
 
 
 @main.command("zcu-src-config")
@@ -335,18 +400,25 @@ def zcu_src_config(obj, link, en_n_src, dlen, rate_rdx):
     if en_n_src > n_srcs_p_mgt:
         raise ValueError(f"{en_n_src} must be lower than the number of generators per link ({n_srcs_p_mgt})")
 
+    ctrl = hw.node('ctrl')
+    src_ctrl = hw.node('src.ctrl')
+
+    ops = []
     for i in range(n_srcs_p_mgt):
         src_id = n_srcs_p_mgt*link+i
-        hw.write(f'ctrl.sel', src_id)
         src_en = (i<en_n_src)
         print(f'Configuring generator {src_id} : {src_en}')
-        hw.write(f'src.ctrl.en', src_en)
+        ops += ctrl.write_ops({'sel': src_id})
+        ops += src_ctrl.write_ops({'en': src_en})
         if not src_en:
             continue
-        ## Number of words per block
-        hw.write(f'src.ctrl.dlen', dlen)
-        ## ????
-        hw.write(f'src.ctrl.rate_rdx', rate_rdx) 
+        ops += src_ctrl.write_ops({
+            ## Number of words per block
+            'dlen': dlen,
+            ## ????
+            'rate_rdx': rate_rdx,
+        })
+    hw.batch(ops)
 
 
 
@@ -407,9 +479,14 @@ def src_config(obj, link, n_src, dlen, rate_rdx):
 @click.pass_obj
 @click.option('-l', '--links', 'sel_links', type=click.Choice(mgts_all), multiple=True, default=None)
 @click.option('-s', '--seconds', type=int, default=0)
-def stats(obj, sel_links, seconds):
+@click.option('-f', '--format', 'fmt', type=click.Choice(FORMATS), default='table', help='Output format, jsonl and csv stream one record per register')
+@click.option('-e', '--every', type=float, default=None, help='With jsonl/csv, read the registers again every N seconds')
+def stats(obj, sel_links, seconds, fmt, every):
     """Simple program that greets NAME for a total of COUNT times."""
 
+    if every is not None and fmt == 'table':
+        raise click.UsageError("--every needs the jsonl or csv format")
+
     hw = obj.hw
 
     n_src = obj.n_src
@@ -427,16 +504,21 @@ def stats(obj, sel_links, seconds):
 
     # Check for existance
     if not set(sel_links).issubset(mgts):
-        print(sel_links, mgts)
         raise ValueError(f"MGTs {set(sel_links)-set(mgts)} are not instantiated")
     
     # mgts = [int(s) for s in (mgts if mgts else [0])]
 
-    print(f"seconds counters for {seconds}s")
+    print(f"seconds counters for {seconds}s", file=sys.stderr)
     hw.write('tx.samp.ctrl.samp', True)
     time.sleep(seconds)
     hw.write('tx.samp.ctrl.samp', False)
 
+    if fmt != 'table':
+        stream_stats(hw, obj.ctrl_id, fmt, sel_links, n_srcs_p_mgt, every)
+        return
+
+    from rich.table import Table
+    from rich.progress import track
 
     # print('---Reading info regs---')
     ctrl_i = read_regs(hw, hw.get_regs('tx.info.*'))
@@ -524,5 +606,194 @@ def stats(obj, sel_links, seconds):
         print(t)
         
 
+
+def link_stats_ops(hw, link, n_srcs_p_mgt):
+    """Operations reading what 'stats' shows for one link
+
+    Returns the operations and the (buf, names, first op) of each register group.
+    """
+    ops = hw.node('tx.csr.ctrl').write_ops({'sel': link})
+    groups = []
+
+    def reads(buf, regex):
+        names = hw.merge_wide(hw.get_regs(regex))
+        groups.append((buf, names, len(ops)))
+        ops.extend(hw.read_ops(names))
+
+    reads(None, 'tx.mux.csr.ctrl.*')
+    reads(None, 'tx.mux.csr.stat.*')
+    reads(None, 'tx.mux.mux.ctrl.*')
+    reads(None, 'tx.mux.mux.stat.*')
+    reads(None, f'tx.udp.udp_core_{link}.udp_core_control.packet_counters.*')
+    reads(None, f'tx.udp.udp_core_{link}.udp_core_control.nz_rst_ctrl.(filter_control|src|dst|udp).*')
+
+    for j in range(n_srcs_p_mgt):
+        ops += hw.node('tx.mux.csr.ctrl').write_ops({'sel_buf': j})
+        reads(j, 'tx.mux.buf.*')
+    return ops, groups
+
+
+def stream_stats(hw, ctrl_id, fmt, sel_links, n_srcs_p_mgt, every=None):
+    """Same registers as 'stats', written as records link by link
+
+    The read set of each link is prepared on the server once, with 'every'
+    it is then read again every 'every' seconds until interrupted, the
+    server sending only the values that changed.
+    """
+    out = RecordWriter(fmt, host=ctrl_id)
+
+    out.write(read_regs(hw, hw.get_regs('tx.info.*')))
+
+    links = []
+    for i in sel_links:
+        ops, groups = link_stats_ops(hw, i, n_srcs_p_mgt)
+        links.append((i, hw.prepare(ops), groups))
+
+    try:
+        while True:
+            t0 = time.time()
+            for i, prep, groups in links:
+                vals = prep.execute(delta=every is not None)
+                t = time.time()
+                for buf, names, first in groups:
+                    out.write(hw.read_vals(names, vals[first:first+len(names)]), link=i, buf=buf, t=t)
+            if every is None:
+                break
+            time.sleep(max(0, every-(time.time()-t0)))
+    except KeyboardInterrupt:
+        pass
+
+@main.command()
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between the two samples compared')
+@click.option('-n', '--passes', type=int, default=1, help='Number of comparisons, 0 to run until interrupted')
+@click.pass_obj
+def health(obj, interval, passes):
+    """Check the links and buffers against the health rules"""
+    from crappyhealth import HealthReader, evaluate, alarms_to_table
+
+    reader = HealthReader(obj.hw, obj.ctrl_id, obj.n_mgt, obj.n_src//obj.n_mgt)
+
+    prev = reader.read()
+    n = 0
+    try:
+        while not passes or n < passes:
+            time.sleep(interval)
+            cur = reader.read()
+            alarms = evaluate(cur, prev)
+            print(alarms_to_table(alarms, title=f"{obj.ctrl_id} health {time.strftime('%H:%M:%S')}: {len(alarms)} alarms"))
+            prev = cur
+            n += 1
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command()
+@click.option('-l', '--links', 'sel_links', type=click.Choice(mgts_all), multiple=True, default=None)
+@click.option('-k', '--kind', type=click.Choice(('fake', 'zcu')), default='fake', help='Sources configured, as fakesrc-config or zcu-src-config')
+@click.option('-n', '--en-n-src', 'n_srcs', type=click.IntRange(1, MAX_SRCS_P_MGT), multiple=True, default=(1, 2, 4))
+@click.option('-d', '--dlen', 'dlens', type=click.IntRange(0, 0xfff), multiple=True, default=(0x100, 0x382))
+@click.option('-r', '--rate-rdx', 'rate_rdxs', type=click.IntRange(0, 0x3f), multiple=True, default=(8, 9, 10, 11, 12))
+@click.option('-w', '--window', type=float, default=1., help='Seconds sampled at each point')
+@click.option('--settle', type=float, default=0.2, help='Seconds between configuring a point and sampling it')
+@click.option('-o', '--output', type=click.Path(), default=None, help='csv file with every point (default: <board>_sweep_<time>.csv)')
+@click.pass_obj
+def sweep(obj, sel_links, kind, n_srcs, dlens, rate_rdxs, window, settle, output):
+    """Measure the source throughput over a grid of settings, and restore them"""
+    from rich.table import Table
+    from rich.progress import track
+    from crappysweep import sweep as run_sweep, best_points, save_results
+
+    hw = obj.hw
+    n_srcs_p_mgt = obj.n_src//obj.n_mgt
+    links = [int(s) for s in sel_links] if sel_links else list(range(obj.n_mgt))
+
+    if not set(links).issubset(range(obj.n_mgt)):
+        raise ValueError(f"MGTs {set(links)-set(range(obj.n_mgt))} are not instantiated")
+    if max(n_srcs) > n_srcs_p_mgt:
+        raise ValueError(f"{max(n_srcs)} must be lower than the number of generators per link ({n_srcs_p_mgt})")
+
+    results = run_sweep(
+        hw, kind, links, n_srcs_p_mgt, n_srcs, dlens, rate_rdxs, settle, window,
+        progress=lambda points: track(points, description='Sweeping')
+    )
+    best = best_points(results)
+
+    t = Table(title=f'{obj.ctrl_id} {kind} sources sweep')
+    for c in ('link', 'n_src', 'dlen', 'rate_rdx', 'pkt/s', 'bytes/s', 'vol/s', 'rejected', 'overflowed', 'mux oflow', 'hwm'):
+        t.add_column(c)
+    for r in results:
+        if best.get(r['link']) is r:
+            style = 'bold green'
+        elif not r['drop_free']:
+            style = 'red'
+        else:
+            style = None
+        t.add_row(
+            str(r['link']), str(r['n_src']), hex(r['dlen']), hex(r['rate_rdx']),
+            f"{r['pkt_rate']:.1f}", f"{r['byte_rate']:.3e}", f"{r['vol_rate']:.3e}",
+            str(r['rejected']), str(r['overflowed']), str(r['mux_oflow']), hex(r['hwm']),
+            style=style
+        )
+    print(t)
+
+    for l in links:
+        b = best.get(l)
+        if b is None:
+            print(f"link {l}: no drop-free point with traffic")
+            continue
+        print(f"link {l}: best drop-free n_src={b['n_src']} dlen={hex(b['dlen'])} rate_rdx={hex(b['rate_rdx'])}, {b['byte_rate']:.3e} bytes/s")
+
+    if output is None:
+        output = f"{obj.ctrl_id}_sweep_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    save_results(output, obj.ctrl_id, results)
+    print(f"{len(results)} points saved to '{output}', configuration restored")
+
+
+@main.command()
+@click.option('-o', '--output', type=click.Path(), default=None)
+@click.pass_obj
+def snapshot(obj, output):
+    """Dump the whole address space to a snapshot file"""
+    from crappysnap import take_snapshot
+
+    hw = obj.hw
+
+    if output is None:
+        output = f"{obj.ctrl_id}_{time.strftime('%Y%m%d_%H%M%S')}.npz"
+
+    s = take_snapshot(hw, host=obj.ctrl_id)
+    s.save(output)
+    print(f"Snapshot of {len(s.words)} words (firmware {s.meta['firmware']}) taken in {s.meta['duration']:.3f}s, saved to '{output}'")
+
+
+@main.command()
+@click.argument('trace', type=click.Path(exists=True))
+@click.option('-v', '--verify', type=str, default=None, help='Read back the replayed writes to registers matching this regex')
+@click.pass_obj
+def replay(obj, trace, verify):
+    """Replay a recorded operation trace"""
+    from crappytrace import load_trace, replay_trace
+
+    hw = obj.hw
+
+    ops = load_trace(trace)
+    t0 = time.time()
+    n_checked = replay_trace(hw, ops, verify)
+    print(f"Replayed {len(ops)} operations in {time.time()-t0:.3f}s, {n_checked} writes verified")
+
+
+@main.command()
+@click.option('-n', '--last', type=int, default=100, help='Number of records to fetch')
+@click.pass_obj
+def flightrec(obj, last):
+    """Show the latest operations in the server flight recorder"""
+
+    from crappyflight import records_to_table
+
+    hw = obj.hw
+
+    print(records_to_table(hw.flightrec(last), title=f'{obj.ctrl_id} flight recorder'))
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+import threading
+import time
+import click
+import numpy as np
+
+from crappybutler import CrappyObj, ctrl_hosts
+from crappyhealth import LINK_FIELDS, BUF_FIELDS, HealthReader, evaluate
+
+# Counters shown along with their rate, and their column heading
+LINK_COUNTERS = {'udp_count': 'udp', 'dropped_ip': 'drop ip', 'dropped_mac': 'drop mac', 'dropped_port': 'drop port'}
+BUF_COUNTERS = {'blk_acc': 'acc', 'blk_rej': 'rej', 'blk_oflow': 'oflow', 'vol': 'vol'}
+
+
+class BoardPoller(threading.Thread):
+    """Samples one board every 'interval' seconds, keeping the last two samples
+
+    The connection is opened, and opened again after an error, by the
+    thread itself.
+    """
+
+    def __init__(self, ctrl_id, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.ctrl_id = ctrl_id
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples = (None, None)
+        self.error = None
+        self.seq = 0
+
+    def run(self):
+        reader = None
+        while True:
+            t0 = time.time()
+            try:
+                if reader is None:
+                    obj = CrappyObj(self.ctrl_id, use_agent=None, record=None)
+                    reader = HealthReader(obj.hw, self.ctrl_id, obj.n_mgt, obj.n_src//obj.n_mgt)
+                s = reader.read(delta=True)
+                with self.lock:
+                    self.samples = (self.samples[1], s)
+                    self.error = None
+                    self.seq += 1
+            except Exception as e:
+                reader = None
+                with self.lock:
+                    self.samples = (None, None)
+                    self.error = f"{type(e).__name__}: {e}"
+                    self.seq += 1
+            time.sleep(max(0, self.interval-(time.time()-t0)))
+
+    def latest(self):
+        with self.lock:
+            return self.seq, self.samples, self.error
+
+
+def fmt_count(v):
+    return hex(int(v))
+
+
+def fmt_rate(v):
+    return f'{v:.1f}'
+
+
+def counter_rates(vals, prev_vals, dt, fields, names):
+    """The counters 'names' of the last axis of 'vals', each followed by its rate"""
+    idx = [fields.index(n) for n in names]
+    c = vals[..., idx].astype(np.float64)
+    if prev_vals is None:
+        r = np.zeros_like(c)
+    else:
+        d = vals[..., idx].astype(np.int64)-prev_vals[..., idx].astype(np.int64)
+        # Counters reset or wrapped around between the samples
+        r = np.clip(d, 0, None)/dt
+    return np.stack([c, r], axis=-1).reshape(*c.shape[:-1], 2*len(names))
+
+
+class CellGrid:
+    """Formatted cells of a table, only the cells whose value changed are formatted again"""
+
+    def __init__(self, labels, columns, fmts):
+        self.labels = labels
+        self.columns = columns
+        self.fmts = fmts
+        self.vals = None
+        self.cells = None
+
+    def update(self, vals):
+        """Update from a (rows, columns) array, returns whether any cell changed"""
+        if self.vals is None or self.vals.shape != vals.shape:
+            self.cells = [['']*vals.shape[1] for _ in range(vals.shape[0])]
+            changed = np.ones(vals.shape, dtype=bool)
+        else:
+            changed = vals != self.vals
+
+        rows, cols = np.nonzero(changed)
+        for r, c in zip(rows, cols):
+            self.cells[r][c] = self.fmts[c](vals[r, c])
+        self.vals = vals
+        return len(rows) > 0
+
+    def table(self, styles=None, **kwargs):
+        from rich.table import Table
+
+        t = Table(**kwargs)
+        for c in self.columns:
+            t.add_column(c)
+        for i, (label, cells) in enumerate(zip(self.labels, self.cells)):
+            t.add_row(*label, *cells, style=styles.get(i) if styles else None)
+        return t
+
+
+class BoardView:
+    """Link and buffer tables of one board"""
+
+    def __init__(self, ctrl_id):
+        self.ctrl_id = ctrl_id
+        self.link = None
+        self.buf = None
+        self.error = None
+        self.alarms = []
+        self.renderable = None
+
+    def _grids(self, n_links, n_bufs):
+        rate_cols = lambda names: [c for n in names.values() for c in (n, n+'/s')]
+        self.link = CellGrid(
+            [(str(i),) for i in range(n_links)],
+            ['link', 'tx_en', 'err', *rate_cols(LINK_COUNTERS)],
+            [fmt_count]*2+[fmt_count, fmt_rate]*len(LINK_COUNTERS)
+        )
+        self.buf = CellGrid(
+            [(str(i), str(j)) for i in range(n_links) for j in range(n_bufs)],
+            ['link', 'buf', 'en', *rate_cols(BUF_COUNTERS)],
+            [fmt_count]+[fmt_count, fmt_rate]*len(BUF_COUNTERS)
+        )
+
+    def update(self, prev, cur, error):
+        """Update from the latest samples, returns whether the view changed"""
+        if error is not None or cur is None:
+            changed = error != self.error
+            self.error = error
+            if changed:
+                self.render()
+            return changed
+
+        n_links, n_bufs = cur.buf.shape[:2]
+        if self.link is None or len(self.buf.labels) != n_links*n_bufs:
+            self._grids(n_links, n_bufs)
+
+        lf = list(LINK_FIELDS)
+        bf = list(BUF_FIELDS)
+        dt = None if prev is None else max(cur.time-prev.time, 1e-6)
+        link = np.concatenate([
+            cur.link[:, [lf.index('tx_en'), lf.index('err')]].astype(np.float64),
+            counter_rates(cur.link, None if prev is None else prev.link, dt, lf, LINK_COUNTERS),
+        ], axis=1)
+        buf = np.concatenate([
+            cur.buf[:, :, [bf.index('fake_en')]].astype(np.float64),
+            counter_rates(cur.buf, None if prev is None else prev.buf, dt, bf, BUF_COUNTERS),
+        ], axis=2).reshape(n_links*n_bufs, -1)
+
+        alarms = evaluate(cur, prev)
+        changed = self.link.update(link) | self.buf.update(buf)
+        changed |= alarms != self.alarms or self.error is not None
+        self.alarms = alarms
+        self.error = None
+        if changed:
+            self.render()
+        return changed
+
+    def render(self):
+        from rich.console import Group
+        from rich.table import Table
+
+        if self.error is not None:
+            self.renderable = f"[bold]{self.ctrl_id}[/]: [red]{self.error}[/]"
+            return
+
+        n_bufs = len(self.buf.labels)//len(self.link.labels)
+        link_styles = {a.link: 'red' for a in self.alarms if a.buf is None}
+        buf_styles = {a.link*n_bufs+a.buf: 'red' for a in self.alarms if a.buf is not None}
+
+        grid = Table.grid(padding=(0, 2))
+        grid.add_row(
+            self.link.table(link_styles, title='links'),
+            self.buf.table(buf_styles, title='buffers'),
+        )
+        caption = f"[bold]{self.ctrl_id}[/]: {len(self.alarms)} alarms"
+        if self.alarms:
+            a = self.alarms[0]
+            caption += f", {a.severity}: {a.message} (link {a.link}{'' if a.buf is None else f' buf {a.buf}'})"
+        self.renderable = Group(caption, grid)
+
+
+@click.command()
+@click.argument('ctrl_ids', type=click.Choice(ctrl_hosts), nargs=-1)
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between the samples of a board')
+@click.option('-r', '--refresh', type=float, default=4., help='Screen refreshes per second, at most')
+def main(ctrl_ids, interval, refresh):
+    """Live counters and rates of a set of boards, all of them by default"""
+    from rich.console import Group
+    from rich.live import Live
+
+    pollers = [BoardPoller(c, interval) for c in (ctrl_ids or ctrl_hosts)]
+    for p in pollers:
+        p.start()
+
+    views = {p.ctrl_id: BoardView(p.ctrl_id) for p in pollers}
+    seen = {p.ctrl_id: 0 for p in pollers}
+
+    try:
+        with Live(auto_refresh=False) as live:
+            while True:
+                changed = False
+                for p in pollers:
+                    seq, (prev, cur), error = p.latest()
+                    if seq == seen[p.ctrl_id]:
+                        continue
+                    seen[p.ctrl_id] = seq
+                    changed |= views[p.ctrl_id].update(prev, cur, error)
+
+                if changed:
+                    live.update(Group(*(v.renderable for v in views.values() if v.renderable is not None)), refresh=True)
+                time.sleep(1/refresh)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import multiprocessing
+import queue
+import socket
+import time
+import click
+import numpy as np
+
+from crappyrcvr import HEADER_BYTES, DLEN_BYTES, SEQ_SHIFT, SEQ_MOD
+
+HEADER_VERSION = 1
+# DUNE timestamp clock
+TS_FREQ = 62.5e6
+# Ref clock frequencies, see tx.info.generics.ref_freq
+REF_FREQS = {'156.25': 156.25e6, '125': 125e6}
+
+# Most rounds, one packet per source, sent between two pacing checks
+BURST = 64
+
+
+def header_word0(detid, crate, slot, stream):
+    """First header word, sequence id and block length left at zero"""
+    return HEADER_VERSION | (detid << 6) | (crate << 12) | (slot << 22) | (stream << 26)
+
+
+def emulate(link, n_src, detid, crate, slot, dlen, pps, host, port, seconds, interval, results):
+    """Send the blocks of the 'n_src' sources of one link, reporting the counts every 'interval' seconds
+
+    A 'pps' of 0 sends as fast as possible.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 << 20)
+    sock.connect((host, port))
+
+    # One preformatted packet per source, only the header words change
+    size = HEADER_BYTES+dlen*DLEN_BYTES
+    pkts = np.zeros((n_src, size), dtype=np.uint8)
+    hdrs = pkts[:, :HEADER_BYTES].view('<u8')
+    base = np.array([
+        header_word0(detid, crate, slot, link*n_src+j) for j in range(n_src)
+    ], dtype=np.uint64) | np.uint64((dlen & 0xfff) << 52)
+    slots = [memoryview(pkts[j]) for j in range(n_src)]
+
+    # Paced, a burst lasts about a millisecond
+    rounds = BURST if not pps else max(1, min(BURST, int(pps/n_src/1000)))
+
+    seq = 0
+    sent = 0
+    reported = 0
+    t0 = time.perf_counter()
+    next_report = t0+interval
+    try:
+        while True:
+            for _ in range(rounds):
+                hdrs[:, 0] = base | np.uint64(seq << SEQ_SHIFT)
+                hdrs[:, 1] = int(time.time()*TS_FREQ)
+                for s in slots:
+                    sock.send(s)
+                seq = (seq+1) % SEQ_MOD
+            sent += rounds*n_src
+
+            now = time.perf_counter()
+            if now >= next_report:
+                results.put((link, sent-reported, (sent-reported)*size))
+                reported = sent
+                next_report += interval
+            if seconds and now-t0 >= seconds:
+                break
+            if pps:
+                # Ahead of the schedule, wait for it
+                ahead = sent/pps-(now-t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+    except KeyboardInterrupt:
+        pass
+
+    results.put((link, sent-reported, (sent-reported)*size))
+    results.put((link, None, None))
+
+
+@click.command()
+@click.option('-H', '--host', default='127.0.0.1', help='Receiver address')
+@click.option('-p', '--port', type=int, default=0x4444)
+@click.option('-l', '--links', type=click.IntRange(1, 16), default=1, help='Links, each sent by its own process')
+@click.option('-n', '--n-src', type=click.IntRange(1, 16), default=1, help='Sources per link')
+@click.option('--detid', type=click.IntRange(0, 0x3f), default=3)
+@click.option('--crate', type=click.IntRange(0, 0x3ff), default=0)
+@click.option('--slot', type=click.IntRange(0, 0xf), default=0)
+@click.option('-d', '--dlen', type=click.IntRange(0, 0xfff), default=0x382)
+@click.option('-r', '--rate-rdx', type=click.IntRange(0, 0x3f), default=0xa, help='A block every 2**rate_rdx ref clock ticks per source')
+@click.option('--ref-freq', type=click.Choice(REF_FREQS), default='156.25', help='Ref clock frequency, MHz')
+@click.option('-x', '--max-rate', is_flag=True, default=False, help='Ignore rate_rdx and send as fast as possible')
+@click.option('-s', '--seconds', type=float, default=10., help='0 to run until interrupted')
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between reports')
+def main(host, port, links, n_src, detid, crate, slot, dlen, rate_rdx, ref_freq, max_rate, seconds, interval):
+    """Emulate the blocks sent by the fake sources of a board"""
+    from rich import print
+    from rich.table import Table
+
+    pps = 0 if max_rate else n_src*REF_FREQS[ref_freq]/(1 << rate_rdx)
+    size = HEADER_BYTES+dlen*DLEN_BYTES
+    target = 'max' if max_rate else f"{pps:.1f} pkt/s, {pps*size*8/1e9:.3f} Gb/s"
+    print(f"{links} links x {n_src} sources of {size} bytes to {host}:{hex(port)}, target per link {target}")
+
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(
+            target=emulate,
+            args=(i, n_src, detid, crate, slot, dlen, pps, host, port, seconds, interval, results),
+            daemon=True
+        )
+        for i in range(links)
+    ]
+    t0 = time.perf_counter()
+    for p in procs:
+        p.start()
+
+    totals = {i: [0, 0] for i in range(links)}
+    recent = [0, 0]
+    running = links
+    t_last = t0
+    try:
+        while running:
+            try:
+                link, n, nbytes = results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if n is None:
+                running -= 1
+                continue
+            totals[link][0] += n
+            totals[link][1] += nbytes
+            recent[0] += n
+            recent[1] += nbytes
+
+            now = time.perf_counter()
+            if now-t_last >= interval:
+                dt = now-t_last
+                print(f"{recent[0]/dt:.1f} pkt/s {recent[1]*8/dt/1e9:.3f} Gb/s")
+                recent = [0, 0]
+                t_last = now
+    except KeyboardInterrupt:
+        # The workers got the interrupt too, collect their last counts
+        for p in procs:
+            p.join()
+        while True:
+            try:
+                link, n, nbytes = results.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if n is not None:
+                totals[link][0] += n
+                totals[link][1] += nbytes
+
+    dt = time.perf_counter()-t0
+    t = Table(title=f'Achieved over {dt:.1f}s')
+    for c in ('link', 'packets', 'pkt/s', 'Gb/s'):
+        t.add_column(c)
+    for i, (n, nbytes) in totals.items():
+        t.add_row(str(i), str(n), f'{n/dt:.1f}', f'{nbytes*8/dt/1e9:.3f}')
+    n = sum(v[0] for v in totals.values())
+    nbytes = sum(v[1] for v in totals.values())
+    t.add_row('all', str(n), f'{n/dt:.1f}', f'{nbytes*8/dt/1e9:.3f}', style='bold')
+    print(t)
+
+
+if __name__ == '__main__':
+    main()
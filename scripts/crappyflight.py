@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import socket
+import struct
+import time
+import click
+
+from crappytrace import OPCODES
+
+# Opcode recorded for requests rejected by the server
+OP_REJECTED = 0xff
+
+_OPNAMES = {v: k for k, v in OPCODES.items()}
+_OPNAMES[OP_REJECTED] = 'rejected'
+
+# Dump file: header followed by the records, oldest first
+FLIGHTREC_MAGIC = b'CRFR'
+FLIGHTREC_VERSION = 1
+_HEADER = struct.Struct('<4sHI')
+# timestamp, client ip, opcode, addr, mask, value, service time [us]
+_RECORD = struct.Struct('<dIBIIIf')
+
+
+def ip_to_u32(ip):
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip))[0]
+    except (OSError, TypeError):
+        return 0
+
+
+def u32_to_ip(v):
+    return socket.inet_ntoa(struct.pack('>I', v))
+
+
+class FlightRecorder:
+    """Fixed size ring buffer of binary operation records
+
+    Recording packs one record in a preallocated buffer, no allocation or
+    formatting happens until the buffer is dumped.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self._buf = bytearray(size*_RECORD.size)
+        self._n = 0
+
+    def __len__(self):
+        return min(self._n, self.size)
+
+    def record(self, client, opcode, addr, mask, val, service_us):
+        _RECORD.pack_into(
+            self._buf, (self._n % self.size)*_RECORD.size,
+            time.time(), client, opcode, addr & 0xffffffff, mask & 0xffffffff, (val or 0) & 0xffffffff, service_us
+        )
+        self._n += 1
+
+    def raw(self, n=None):
+        """Packed records, oldest first"""
+        n = len(self) if n is None else min(n, len(self))
+        end = (self._n % self.size)*_RECORD.size
+        data = self._buf[end:] + self._buf[:end] if self._n >= self.size else self._buf[:end]
+        return bytes(data[len(data)-n*_RECORD.size:])
+
+    def records(self, n=None):
+        """Decoded records, oldest first"""
+        return decode_records(self.raw(n))
+
+    def dump(self, path):
+        data = self.raw()
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(FLIGHTREC_MAGIC, FLIGHTREC_VERSION, len(data)//_RECORD.size))
+            f.write(data)
+
+
+def decode_records(data):
+    return [
+        [ts, u32_to_ip(client), _OPNAMES.get(op, str(op)), addr, mask, val, dt]
+        for ts, client, op, addr, mask, val, dt in _RECORD.iter_unpack(data)
+    ]
+
+
+def load_dump(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, n = _HEADER.unpack_from(data)
+    if magic != FLIGHTREC_MAGIC or version != FLIGHTREC_VERSION:
+        raise ValueError(f"{path} is not a version {FLIGHTREC_VERSION} flight recorder dump")
+    return decode_records(data[_HEADER.size:_HEADER.size+n*_RECORD.size])
+
+
+def records_to_table(records, **kwargs):
+    # rich is not installed on the boards, where the recorder runs
+    from rich.table import Table
+
+    t = Table(**kwargs)
+    for c in ('time', 'client', 'op', 'addr', 'mask', 'value'):
+        t.add_column(c)
+    t.add_column('service (us)', style='green')
+    for ts, client, op, addr, mask, val, dt in records:
+        t.add_row(
+            time.strftime('%H:%M:%S', time.localtime(ts))+f'.{int(ts*1e6)%1000000:06d}',
+            client, op, hex(addr), hex(mask), hex(val), f'{dt:.1f}'
+        )
+    return t
+
+
+@click.command()
+@click.argument('dump', type=click.Path(exists=True))
+@click.option('-n', '--last', type=int, default=None, help='Only show the last N records')
+def main(dump, last):
+    """Print a flight recorder dump"""
+    from rich import print
+
+    records = load_dump(dump)
+    if last is not None:
+        records = records[-last:]
+    print(records_to_table(records, title=dump))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import csv
+import json
+import sys
+import time
+
+# Output formats of the stats commands, 'table' is the rich rendering
+FORMATS = ('table', 'jsonl', 'csv')
+
+
+class RecordWriter:
+    """Streams register values as flat records, one per register
+
+    Values are written as raw integers together with the time they were
+    sampled, and flushed as soon as a group of registers is written so
+    the output can be piped into other tools.
+    """
+
+    FIELDS = ('time', 'host', 'link', 'buf', 'reg', 'value')
+
+    def __init__(self, fmt, host=None, stream=None):
+        if fmt not in ('jsonl', 'csv'):
+            raise ValueError(f"Unsupported record format '{fmt}'")
+        self.fmt = fmt
+        self.host = host
+        self.stream = stream or sys.stdout
+        if fmt == 'csv':
+            self._csv = csv.writer(self.stream, lineterminator='\n')
+            self._csv.writerow(self.FIELDS)
+
+    def write(self, regs, link=None, buf=None, t=None):
+        """Write the values in 'regs' (name -> int), sampled at 't'"""
+        t = time.time() if t is None else t
+        if self.fmt == 'csv':
+            self._csv.writerows(
+                (f'{t:.6f}', self.host, '' if link is None else link, '' if buf is None else buf, r, v)
+                for r, v in regs.items()
+            )
+        else:
+            w = self.stream.write
+            for r, v in regs.items():
+                w(json.dumps({'time': t, 'host': self.host, 'link': link, 'buf': buf, 'reg': r, 'value': v}))
+                w('\n')
+        self.stream.flush()
@@ -2,11 +2,12 @@
 import time
 import os
 import click
-from rich import print
-from rich.table import Table
-from rich.progress import track
+import collections
+import statistics
+import threading
 
-from crappyhalclient import CrappyHardwareClient
+# rich and the hardware client are imported where needed, keeping the
+# start-up of the command line short
 
 ctrl_hosts = [
     'np04-zcu-001',
@@ -14,41 +15,176 @@ ctrl_hosts = [
 ]
 
 port = 5556
-addrtab = os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', 'hermes_zcu_mark3', 'zcu_top.xml')
+
+def addrtab_path():
+    return os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', 'hermes_zcu_mark3', 'zcu_top.xml')
+
+clk_chans = range(4)
+
+def print(*args, **kwargs):
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
+def count_to_freq(cnt):
+    return (cnt*64)/((2**24)/(75e6))
+
+
+def measure_ops(hw, chans):
+    """Batch measuring all channels: select, wait for a valid count, read it"""
+    regs = {n: (int(hw.addrtab[n]['addr'], 0), int(hw.addrtab[n]['mask'], 0)) for n in (
+        'tx.udp.freq.ctrl.chan_sel', 'tx.udp.freq.freq.valid', 'tx.udp.freq.freq.count'
+        )}
+    sel_addr, sel_mask = regs['tx.udp.freq.ctrl.chan_sel']
+    valid_addr, valid_mask = regs['tx.udp.freq.freq.valid']
+    cnt_addr, cnt_mask = regs['tx.udp.freq.freq.count']
+
+    ops = []
+    for c in chans:
+        ops += [
+            ['write', sel_addr, sel_mask, c],
+            ['wait', valid_addr, valid_mask, 1],
+            ['read', cnt_addr, cnt_mask, 0],
+        ]
+    return ops
+
+
+class FreqTracker:
+    """Rolling frequency statistics of one clock channel"""
+
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.n_invalid = 0
+
+    def add(self, f):
+        self.samples.append(f)
+
+    @property
+    def mean(self):
+        return statistics.fmean(self.samples)
+
+    @property
+    def stdev(self):
+        return statistics.pstdev(self.samples)
+
+    def drift_ppm(self):
+        """Min/max deviation from the rolling mean, in ppm"""
+        m = self.mean
+        return (min(self.samples)-m)/m*1e6, (max(self.samples)-m)/m*1e6
+
+
+def track_board(ctrl_id, window, interval, passes, results, lock):
+    from crappyhalclient import CrappyHardwareClient
+
+    hw = CrappyHardwareClient(ctrl_id, port, addrtab_path())
+    hw.connect()
+    # A pass waits for one count per channel on the board
+    hw.timeout = 5000
+
+    ops = measure_ops(hw, clk_chans)
+    trackers = {c: FreqTracker(window) for c in clk_chans}
+
+    n = 0
+    while passes is None or n < passes:
+        t0 = time.time()
+        vals = hw.batch(ops)
+        for i, c in enumerate(clk_chans):
+            valid, cnt = vals[3*i+1], vals[3*i+2]
+            if not valid:
+                trackers[c].n_invalid += 1
+                continue
+            trackers[c].add(count_to_freq(cnt))
+
+        with lock:
+            for c, tr in trackers.items():
+                if not tr.samples:
+                    print(f"{ctrl_id} ch{c}: no valid count")
+                    continue
+                lo, hi = tr.drift_ppm()
+                print(
+                    f"{ctrl_id} ch{c}: {tr.samples[-1]/1e6:.5f} MHz "
+                    f"mean {tr.mean/1e6:.5f} MHz std {tr.stdev/tr.mean*1e6:.2f} ppm "
+                    f"drift ({lo:+.2f}, {hi:+.2f}) ppm n={len(tr.samples)} invalid={tr.n_invalid}"
+                )
+            results[ctrl_id] = trackers
+
+        n += 1
+        time.sleep(max(0, interval-(time.time()-t0)))
+
 
 @click.command()
-@click.argument('ctrl_id', type=click.Choice(ctrl_hosts))
-def main(ctrl_id):
+@click.argument('ctrl_ids', type=click.Choice(ctrl_hosts), nargs=-1, required=True)
+@click.option('-t', '--track', 'tracking', is_flag=True, default=False, help='Continuously track the frequencies')
+@click.option('-w', '--window', type=int, default=60, help='Number of passes in the rolling statistics')
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between passes')
+@click.option('-n', '--passes', type=int, default=None, help='Stop after N passes')
+def main(ctrl_ids, tracking, window, interval, passes):
     """Simple frequency measurement"""
-    hw = CrappyHardwareClient(ctrl_id, port, addrtab)
-    hw.connect()
-    clk_chans = range(4)
+    from rich.table import Table
+    from rich.progress import track
+    from crappyhalclient import CrappyHardwareClient
+
+    if tracking:
+        results = {}
+        lock = threading.Lock()
+        threads = [
+            threading.Thread(target=track_board, args=(c, window, interval, passes, results, lock), daemon=True)
+            for c in ctrl_ids
+            ]
+        for th in threads:
+            th.start()
+        try:
+            for th in threads:
+                th.join()
+        except KeyboardInterrupt:
+            pass
+
+        t = Table(title='Frequency tracking summary')
+        t.add_column('board')
+        t.add_column('channel')
+        t.add_column('Mean freq.', style='green')
+        t.add_column('Std. dev. (ppm)', style='cyan')
+        t.add_column('Drift (ppm)', style='cyan')
+        t.add_column('Samples')
+        for ctrl_id, trackers in results.items():
+            for c, tr in trackers.items():
+                if not tr.samples:
+                    continue
+                lo, hi = tr.drift_ppm()
+                t.add_row(
+                    ctrl_id, str(c), f"{tr.mean/1e6:.5f} MHz", f"{tr.stdev/tr.mean*1e6:.2f}",
+                    f"{lo:+.2f} / {hi:+.2f}", str(len(tr.samples))
+                )
+        print(t)
+        return
 
+    for ctrl_id in ctrl_ids:
+        hw = CrappyHardwareClient(ctrl_id, port, addrtab_path())
+        hw.connect()
 
-    t = Table()
-    t.add_column('channel')
-    t.add_column('Freq.', style='green')
-    t.add_column('Counts.', style='cyan')
+        t = Table(title=ctrl_id)
+        t.add_column('channel')
+        t.add_column('Freq.', style='green')
+        t.add_column('Counts.', style='cyan')
 
-    for c in track(clk_chans, description="Measuring"):
-        # print(f'Measuring channel {c}')
-        hw.write('tx.udp.freq.ctrl.chan_sel', c)
-        while(True):
-            v = hw.read('tx.udp.freq.freq.valid')
-            if v:
-                break
-            time.sleep(1/1000)
-        cnt = hw.read('tx.udp.freq.freq.count')
+        for c in track(clk_chans, description="Measuring"):
+            # print(f'Measuring channel {c}')
+            hw.write('tx.udp.freq.ctrl.chan_sel', c)
+            while(True):
+                v = hw.read('tx.udp.freq.freq.valid')
+                if v:
+                    break
+                time.sleep(1/1000)
+            cnt = hw.read('tx.udp.freq.freq.count')
 
 
-        f = (cnt*64)/((2**24)/(75e6))
-        # print(f"   Freq : {f/1e6:.5f} MHz [Counts {cnt} {hex(cnt)}]")
-        t.add_row(str(c),f"{f/1e6:.5f} MHz",f"{cnt} [{hex(cnt)}]")
-    print(t)
+            f = count_to_freq(cnt)
+            # print(f"   Freq : {f/1e6:.5f} MHz [Counts {cnt} {hex(cnt)}]")
+            t.add_row(str(c),f"{f/1e6:.5f} MHz",f"{cnt} [{hex(cnt)}]")
+        print(t)
 
 
     print('Done')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -42,6 +42,24 @@ class CrappyRawHardware :
         return ((val & mask) >> s)
 
 
+    def read_shifted(self, addr, mask, shift):
+        """read_addr with the shift of the mask precomputed"""
+        return (self._rreg(addr, 1)[0] & mask) >> shift
+
+
+    def write_shifted(self, addr, mask, shift, val):
+        """write_addr with the shift of the mask precomputed"""
+        if mask == 0xffffffff:
+            self._wreg(addr, [val])
+        else:
+            reg_val = self._rreg(addr, 1)[0]
+            self._wreg(addr, [(reg_val & ~mask) | ((val << shift) & mask)])
+
+
+    def read_block(self, addr, n):
+        return list(self._rreg(addr, n))
+
+
     def write_addr(self, addr, mask, val):
         if mask == 0xffffffff:
             self._wreg(addr, [val])
@@ -1,84 +1,514 @@
 #!/usr/bin/env python
 import zmq
 import click
+import collections
+import hashlib
 import json
+import random
+import signal
+import time
 
 import coloredlogs, logging
 logger = logging.getLogger(__name__)
 
 from crappyhal import CrappyRawHardware
+from crappytrace import OPCODES
+from crappyflight import FlightRecorder, OP_REJECTED, ip_to_u32
+from crappyhisto import LatencyStats
+from crappyaddrtab import load_flat_addrtab, register_list, addrtab_hash
+from crappyipc import default_ipc_path
+
+# Words of the AXI window mapped by CrappyRawHardware, valid addresses are below
+AXI_WORDS = 0x40000
+# Largest block accepted by 'read_block' (the whole AXI window)
+MAX_BLOCK_WORDS = AXI_WORDS
+# Largest number of operations accepted in a single 'batch'
+MAX_BATCH_OPS = 0x10000
+
+# Longest time a 'wait' operation polls a register, and polling period
+MAX_WAIT = 1.0
+WAIT_POLL = 1/1000
+# Number of replies to modifying requests kept for deduplication
+DEDUP_SIZE = 1024
+# Attempts of a 'read_wide' before giving up on a high word that keeps changing
+WIDE_RETRIES = 8
+
+# Number of prepared operation lists kept, the least recently registered go first
+MAX_PREPARED = 256
+# Largest number of unrequested words a prepared block read may span, when the
+# client opts in: reading FIFO, clear-on-read or latch registers has side effects
+MAX_PREPARE_GAP = 64
+# Number of delta execution states kept, one per client and prepared list
+MAX_DELTA_STATES = 1024
+
+CAPS = ['read', 'write', 'read_block', 'batch', 'caps', 'flightrec', 'stats', 'dedup', 'read_wide', 'hello', 'reg_ids', 'prepare', 'delta']
+
+# Operations accepted on register ids, [opcode, register id, val] in batches
+REG_OPS = {OPCODES[c]: c for c in ('read', 'write', 'wait')}
+
+class CrappyRequestError(Exception):
+    """Request rejected by the server, the argument is the error code sent back"""
+    pass
+
+
+def check_addr(addr, mask):
+    if not isinstance(addr, int) or addr < 0 or addr >= AXI_WORDS:
+        logger.error("Invalid address received")
+        raise CrappyRequestError('InvalidAddress')
+
+    if not isinstance(mask, int) or mask < 0 or mask > 0xffffffff:
+        logger.error("Invalid mask received")
+        raise CrappyRequestError('InvalidMask')
+
+
+class CrappyHalServer:
+    """Executes decoded requests on the hardware
+
+    Every operation is stored in a flight recorder; only one operation every
+    'log_every' is logged as text. Hardware access latencies are accumulated
+    in 'stats', together with the other stages timed by the receive loop.
+
+    Replies to requests carrying a request id ('rid') are cached, a request
+    resent by a client that missed the reply gets the cached reply back
+    instead of being applied twice.
+
+    With an address table, batch operations can address registers by id,
+    once the client has checked in the 'hello' handshake that both ends
+    use the same table.
+    """
+
+    def __init__(self, hw, flightrec_size=65536, log_every=1000, addrtab=None):
+        self.hw = hw
+        self.flightrec = FlightRecorder(flightrec_size)
+        self.stats = LatencyStats()
+        self.log_every = log_every
+        self._n_ops = 0
+        self._replies = collections.OrderedDict()
+        self._prepared = collections.OrderedDict()
+        self._deltas = collections.OrderedDict()
+
+        self.addrtab_hash = None
+        self.regs = None
+        if addrtab is not None:
+            self.addrtab_hash = addrtab_hash(addrtab)
+            # Register id -> (addr, mask, shift)
+            self.regs = [(a, m, (m & -m).bit_length()-1) for _, a, m in register_list(addrtab)]
+
+    def _log_sampled(self, cmd, addr, mask, val, v):
+        self._n_ops += 1
+        if self.log_every and self._n_ops % self.log_every == 0:
+            logger.info(f"Op {self._n_ops}: {cmd} {hex(addr)}/{hex(mask)} val {val} -> {v}")
+
+    def exec_op(self, cmd, addr, mask, val, client=0, shift=None):
+        """Execute a single hardware operation, returning the value read if any
+
+        'shift' is the precomputed shift of the mask of a table register.
+        """
+
+        try:
+            check_addr(addr, mask)
+
+            t0 = time.perf_counter()
+            if cmd == 'read':
+                if shift is None:
+                    v = self.hw.read_addr(addr, mask)
+                else:
+                    v = self.hw.read_shifted(addr, mask, shift)
+                rec_val = v
+
+            elif cmd == 'read_block':
+                n = val if val is not None else 1
+                if n < 1 or n > MAX_BLOCK_WORDS or addr + n > MAX_BLOCK_WORDS:
+                    logger.error("Invalid block size received")
+                    raise CrappyRequestError('InvalidBlockSize')
+                v = self.hw.read_block(addr, n)
+                rec_val = n
+
+            elif cmd == 'read_wide':
+                # Low word at addr, high word at val. The high word is read
+                # before and after the low one, a carry in between retries.
+                if not isinstance(val, int):
+                    logger.error("Invalid high word address received")
+                    raise CrappyRequestError('InvalidAddress')
+                check_addr(val, mask)
+                for _ in range(WIDE_RETRIES):
+                    hi = self.hw.read_addr(val, mask)
+                    lo = self.hw.read_addr(addr, mask)
+                    if self.hw.read_addr(val, mask) == hi:
+                        break
+                else:
+                    logger.error(f"High word {hex(val)} kept changing")
+                    raise CrappyRequestError('TornRead')
+                v = [lo, hi]
+                rec_val = lo
+
+            elif cmd == 'write':
+                if shift is None:
+                    self.hw.write_addr(addr, mask, val)
+                else:
+                    self.hw.write_shifted(addr, mask, shift, val)
+                v = rec_val = None if val is None else int(val)
+
+            elif cmd == 'wait':
+                # Poll until the register holds 'val', return the last value read
+                while True:
+                    v = self.hw.read_addr(addr, mask)
+                    if v == val or time.perf_counter()-t0 > MAX_WAIT:
+                        break
+                    time.sleep(WAIT_POLL)
+                rec_val = v
+
+            else:
+                logger.error("Invalid command received")
+                raise CrappyRequestError('InvalidCommand')
+            dt = time.perf_counter()-t0
+
+        except (CrappyRequestError, TypeError, ValueError):
+            self.flightrec.record(client, OP_REJECTED, addr if isinstance(addr, int) else 0, 0, 0, 0)
+            raise
+
+        self.flightrec.record(client, OPCODES[cmd], addr, mask, rec_val, dt*1e6)
+        self.stats.add('hw', cmd, dt)
+        self._log_sampled(cmd, addr, mask, val, v)
+        return None if cmd == 'write' else v
+
+    def exec_reg_op(self, opcode, rid, val=None, client=0):
+        """Execute a batch operation on a register of the address table"""
+
+        cmd = REG_OPS.get(opcode)
+        if cmd is None:
+            logger.error("Invalid register operation received")
+            raise CrappyRequestError('InvalidCommand')
+        if not isinstance(rid, int) or not 0 <= rid < len(self.regs):
+            logger.error("Invalid register id received")
+            raise CrappyRequestError('InvalidRegister')
+
+        addr, mask, shift = self.regs[rid]
+        return self.exec_op(cmd, addr, mask, val, client, shift)
+
+    def resolve_op(self, op, reg_ids):
+        """Validate a batch operation, returning it as (cmd, addr, mask, val, shift)"""
+
+        if op and isinstance(op[0], int):
+            if not reg_ids:
+                raise CrappyRequestError('AddrtabMismatch')
+            opcode, rid, *val = op
+            cmd = REG_OPS.get(opcode)
+            if cmd is None:
+                raise CrappyRequestError('InvalidCommand')
+            if not isinstance(rid, int) or not 0 <= rid < len(self.regs):
+                raise CrappyRequestError('InvalidRegister')
+            addr, mask, shift = self.regs[rid]
+            return cmd, addr, mask, val[0] if val else None, shift
+
+        cmd, addr, mask, val = op
+        if cmd not in OPCODES:
+            raise CrappyRequestError('InvalidCommand')
+        check_addr(addr, mask)
+        return cmd, addr, mask, val, None
+
+    def prepare(self, ops, gap=0):
+        """Compile an operation list for repeated execution, returning its handle
+
+        Runs of reads between the operations with side effects (writes,
+        waits, wide reads) are sorted by address and merged into block reads
+        of contiguous addresses. A 'gap' lets a block read also span up to
+        that many words nobody asked for.
+        """
+        steps = []
+        reads = []
+
+        def flush_reads():
+            if not reads:
+                return
+            blocks = []
+            extract = []
+            for i, addr, mask, shift in sorted(reads, key=lambda r: r[1]):
+                if not blocks or addr > blocks[-1][0]+blocks[-1][1]+gap:
+                    blocks.append([addr, 1])
+                else:
+                    blocks[-1][1] = max(blocks[-1][1], addr-blocks[-1][0]+1)
+                extract.append((i, len(blocks)-1, addr-blocks[-1][0], mask, shift))
+            steps.append(('blocks', blocks, extract))
+            reads.clear()
+
+        for i, (cmd, addr, mask, val, shift) in enumerate(ops):
+            if cmd == 'read':
+                reads.append((i, addr, mask, (mask & -mask).bit_length()-1 if shift is None else shift))
+            else:
+                flush_reads()
+                steps.append(('op', i, cmd, addr, mask, val, shift))
+        flush_reads()
+
+        # Clients registering the same list share the handle
+        handle = hashlib.sha1(json.dumps([gap, ops]).encode()).hexdigest()[:16]
+        self._prepared[handle] = (len(ops), steps)
+        self._prepared.move_to_end(handle)
+        if len(self._prepared) > MAX_PREPARED:
+            self._prepared.popitem(last=False)
+        return handle
+
+    def execute(self, handle, client=0):
+        """Run a prepared operation list, returning the values as a batch would"""
+
+        n, steps = self._prepared[handle]
+        vals = [None]*n
+        for step in steps:
+            if step[0] == 'op':
+                _, i, cmd, addr, mask, val, shift = step
+                vals[i] = self.exec_op(cmd, addr, mask, val, client, shift)
+                continue
+
+            _, blocks, extract = step
+            words = [self.exec_op('read_block', start, 0xffffffff, size, client) for start, size in blocks]
+            for i, b, offset, mask, shift in extract:
+                vals[i] = (words[b][offset] & mask) >> shift
+        return vals
+
+    def delta_reply(self, handle, version, vals):
+        """Reply with the values changed since the reply carrying 'version'
+
+        The values are stored under a new random version token, the client
+        sends it back with its next request. Unknown or stale tokens get
+        all the values.
+        """
+        prev = self._deltas.pop(version, None)
+        token = random.getrandbits(62)
+        # In-process clients get 'vals' itself and update it in place
+        self._deltas[token] = (handle, list(vals))
+        if len(self._deltas) > MAX_DELTA_STATES:
+            self._deltas.popitem(last=False)
+
+        if prev is None or prev[0] != handle:
+            return {'batch_vals': vals, 'version': token}
+        return {'delta': [[i, v] for i, (old, v) in enumerate(zip(prev[1], vals)) if v != old], 'version': token}
+
+    def handle(self, d, client=0):
+        """Process a decoded request, returning the reply"""
+
+        rid = d.get('rid')
+        if rid is None:
+            return self._handle(d, client)
+        if not isinstance(rid, int):
+            logger.error("Invalid request id received")
+            return {'error': 'InvalidRid'}
+
+        key = (client, rid)
+        rpl = self._replies.get(key)
+        if rpl is not None:
+            logger.warning(f"Request {rid} from {client} already applied, resending reply")
+            return dict(rpl, dup=True)
+
+        rpl = self._handle(d, client)
+        self._replies[key] = rpl
+        if len(self._replies) > DEDUP_SIZE:
+            self._replies.popitem(last=False)
+        return rpl
+
+    def _handle(self, d, client):
+
+        if not set(d.keys()).issubset({'cmd', 'addr', 'mask', 'val', 'n', 'ops', 'reset', 'rid', 'hash', 'handle', 'version', 'gap'}):
+            logger.error("Invalid message received")
+            return {'error': 'InvalidMessage'}
+
+        cmd = d.get('cmd')
+
+        if cmd == 'caps':
+            return {'caps': CAPS}
+
+        elif cmd == 'hello':
+            # Clients built against another table are turned away here,
+            # before sending anything to the hardware
+            rpl = {'caps': CAPS, 'hash': self.addrtab_hash}
+            if self.addrtab_hash is not None and d.get('hash') != self.addrtab_hash:
+                logger.error(f"Client {client} address table {d.get('hash')} does not match {self.addrtab_hash}")
+                rpl['error'] = 'AddrtabMismatch'
+            return rpl
+
+        elif cmd == 'flightrec':
+            n = d.get('n')
+            if n is not None and (not isinstance(n, int) or n < 0):
+                logger.error("Invalid record count received")
+                return {'error': 'InvalidCount'}
+            return {'flightrec': self.flightrec.records(n)}
+
+        elif cmd == 'stats':
+            rpl = {'stats': self.stats.to_dict()}
+            if d.get('reset'):
+                self.stats.reset()
+            return rpl
+
+        elif cmd == 'prepare':
+            # Same operations as a batch, executed later by handle
+            ops = d.get('ops', [])
+            if not isinstance(ops, list) or not all(isinstance(op, list) for op in ops):
+                logger.error("Invalid operation list received")
+                return {'error': 'InvalidOperation'}
+            if len(ops) > MAX_BATCH_OPS:
+                logger.error("Invalid batch size received")
+                return {'error': 'InvalidBatchSize'}
+            gap = d.get('gap', 0)
+            if not isinstance(gap, int) or not 0 <= gap <= MAX_PREPARE_GAP:
+                logger.error("Invalid prepare gap received")
+                return {'error': 'InvalidGap'}
+            reg_ids = self.regs is not None and d.get('hash') == self.addrtab_hash
+            try:
+                ops = [self.resolve_op(op, reg_ids) for op in ops]
+            except CrappyRequestError as e:
+                logger.error(f"Invalid operation list received: {e}")
+                return {'error': str(e)}
+            except (TypeError, ValueError):
+                logger.error("Invalid operation list received")
+                return {'error': 'InvalidOperation'}
+            return {'handle': self.prepare(ops, gap)}
+
+        elif cmd == 'execute':
+            if not isinstance(d.get('handle'), str):
+                logger.error("Invalid handle received")
+                return {'error': 'InvalidHandle'}
+            if d['handle'] not in self._prepared:
+                return {'error': 'UnknownHandle'}
+            if d.get('version') is not None and not isinstance(d['version'], int):
+                logger.error("Invalid version received")
+                return {'error': 'InvalidVersion'}
+            try:
+                vals = self.execute(d['handle'], client)
+            except (CrappyRequestError, TypeError, ValueError) as e:
+                return {'error': str(e) if isinstance(e, CrappyRequestError) else 'InvalidOperation'}
+            if 'version' in d:
+                # Only the values changed since the client's last reply
+                return self.delta_reply(d['handle'], d['version'], vals)
+            return {'batch_vals': vals}
+
+        elif cmd == 'batch':
+            # Operations are [cmd, addr, mask, val] lists, executed in order.
+            # Execution stops at the first failing operation.
+            # A 'wait' operation polls addr until it holds val, for at most
+            # MAX_WAIT seconds. A 'read_wide' returns the [low, high] words
+            # at addr and val.
+            # Operations on table registers are [opcode, register id, val]
+            # lists, the request must carry the hash of the table.
+            ops = d.get('ops', [])
+            if not isinstance(ops, list) or not all(isinstance(op, list) for op in ops):
+                logger.error("Invalid operation list received")
+                return {'error': 'InvalidOperation', 'batch_vals': []}
+            if len(ops) > MAX_BATCH_OPS:
+                logger.error("Invalid batch size received")
+                return {'error': 'InvalidBatchSize'}
+            reg_ids = self.regs is not None and d.get('hash') == self.addrtab_hash
+            if not reg_ids and any(op and isinstance(op[0], int) for op in ops):
+                # Rejected before executing anything, the client can resend raw operations
+                logger.error("Register ids received without a matching address table")
+                return {'error': 'AddrtabMismatch', 'batch_vals': []}
+            vals = []
+            for op in ops:
+                try:
+                    if op and isinstance(op[0], int):
+                        vals.append(self.exec_reg_op(*op, client=client))
+                        continue
+                    vals.append(self.exec_op(*op, client=client))
+                except (CrappyRequestError, TypeError, ValueError) as e:
+                    return {'error': str(e) if isinstance(e, CrappyRequestError) else 'InvalidOperation', 'batch_vals': vals}
+            return {'batch_vals': vals}
+
+        try:
+            if cmd == 'read_block':
+                v = self.exec_op(cmd, d['addr'], 0xffffffff, d.get('n', 1), client)
+                return {'read_vals': v}
+
+            if cmd == 'read_wide':
+                v = self.exec_op(cmd, d['addr'], d.get('mask', 0xffffffff), d.get('val'), client)
+                return {'read_vals': v}
+
+            v = self.exec_op(cmd, d['addr'], d.get('mask', 0xffffffff), d.get('val'), client)
+        except CrappyRequestError as e:
+            return {'error': str(e)}
+        except (TypeError, ValueError):
+            logger.error("Invalid operation received")
+            return {'error': 'InvalidOperation'}
+        except KeyError:
+            logger.error("Invalid message received")
+            return {'error': 'InvalidMessage'}
+
+        if cmd == 'read':
+            return {'read_val': hex(v)}
+        else:
+            return {'write_done': True}
+
 
 @click.command()
 @click.option('-p', '--port', type=int, default=5556)
-def main(port):
+@click.option('--flightrec-size', type=int, default=65536, help='Number of operations kept by the flight recorder')
+@click.option('--flightrec-dump', type=click.Path(), default='/var/log/crappyhw_server.flightrec', help='Flight recorder dump file, written on SIGUSR1')
+@click.option('--log-every', type=int, default=1000, help='Log one operation every N (0 to disable)')
+@click.option('--addrtab', type=click.Path(exists=True), default=None, help='Compiled json address table, enables register ids')
+@click.option('--ipc', 'ipc_path', type=click.Path(), default=default_ipc_path, help="Unix socket for the clients on the board, CRAPPYHAL_SOCKET by default ('' to disable)")
+def main(port, flightrec_size, flightrec_dump, log_every, addrtab, ipc_path):
+
+    if addrtab is not None:
+        addrtab = load_flat_addrtab(addrtab)
+    srv = CrappyHalServer(CrappyRawHardware(), flightrec_size, log_every, addrtab)
+    if addrtab is not None:
+        logger.info(f"Loaded {len(srv.regs)} registers, address table {srv.addrtab_hash}")
 
-    hw = CrappyRawHardware()
+    def dump_flightrec(signum, frame):
+        srv.flightrec.dump(flightrec_dump)
+        logger.warning(f"Flight recorder dumped to {flightrec_dump}")
+    signal.signal(signal.SIGUSR1, dump_flightrec)
 
     context = zmq.Context()
     socket = context.socket(zmq.REP)
     socket.bind("tcp://*:%s" % port)
+    if ipc_path:
+        socket.bind(f"ipc://{ipc_path}")
+
+    stats = srv.stats
+    clock = time.perf_counter
 
     logger.info('Starting crappyhal server')
     while True:
-        #  Wait for next request from client
-        message = socket.recv()
-        logger.debug(f"Received request: {message.decode()}")
+        #  Wait for next request from client, idle time is not accounted
+        socket.poll()
+        t0 = clock()
+        frame = socket.recv(copy=False)
+        message = frame.bytes
+        t1 = clock()
         try:
             d = json.loads(message)
+            cmd = d.get('cmd')
         except:
-            logger.error(f"Failed to deserialize {message.decode(())} to json")
+            logger.error(f"Failed to deserialize {message.decode(errors='replace')} to json")
             socket.send(json.dumps({'error': 'InvalidJSONFormat'}).encode())
             continue
+        t2 = clock()
 
-        if not set(d.keys()).issubset({'cmd', 'addr', 'mask', 'val'}):
-            logger.error("Invalid message received")
-            socket.send(json.dumps({'error': 'InvalidMessage'}).encode())
-            continue
-        
-        cmd = d['cmd']
-        # addr = int(d['addr'], 0)
-        # mask = int(d['mask'], 0)
-        # val = int(d['val'], 0) if 'val' in d else None
-        addr = d['addr']
-        mask = d['mask']
-        val = d['val'], 0 if 'val' in d else None
-
-        if addr < 0 or addr > 0xffffffff:
-            logger.error("Invalid address received")
-            socket.send(json.dumps({'err': 'InvalidAddress'}).encode())
-            continue
-
-        if mask < 0 or mask > 0xffffffff:
-            logger.error("Invalid address received")
-            socket.send(json.dumps({'err': 'InvalidAddress'}).encode())
-            continue
-
-        # if cmd not in ['read', 'write']:
-        #     print("Invalid command received")
-        #     socket.send(json.dumps({'error': 'InvalidCommand'}).encode())
-        #     continue
-
-        if cmd == 'read':
-            v = hw.read_addr(addr, mask)
-            logger.info(f"Read {hex(v)} at {hex(addr)} with mask {hex(mask)}")
-            socket.send(json.dumps({'read_val': hex(v)}).encode())
-            continue
+        try:
+            client = ip_to_u32(frame.get('Peer-Address'))
+        except zmq.ZMQError:
+            client = 0
 
-        elif cmd == 'write':
-            hw.write_addr(addr, mask, val)
-            logger.info(f"Write {hex(val)} at {hex(addr)} with mask {hex(mask)}")
-            socket.send(json.dumps({'write_done': True}).encode())
-            continue
+        try:
+            rpl = srv.handle(d, client)
+        except Exception as e:
+            # A request slipping through the checks must not take the server down
+            logger.exception(f"Failed to handle {message.decode(errors='replace')}")
+            rpl = {'error': type(e).__name__}
+        t3 = clock()
+        message = json.dumps(rpl).encode()
+        t4 = clock()
+        socket.send(message)
+        t5 = clock()
 
-        else:
-            print("Invalid command received")
-            socket.send(json.dumps({'error': 'InvalidCommand'}).encode())
-            continue   
-        
+        cmd = str(cmd)
+        stats.add('recv', cmd, t1-t0)
+        stats.add('decode', cmd, t2-t1)
+        stats.add('handle', cmd, t3-t2)
+        stats.add('encode', cmd, t4-t3)
+        stats.add('send', cmd, t5-t4)
 
 
 if __name__ == '__main__':
-    
+
     coloredlogs.install(level='INFO', logger=logger)
 
-    main()
\ No newline at end of file
+    main()
@@ -1,85 +1,634 @@
 #!/usr/bin/env python
 
-import zmq
-import sys
 import json
-import rich
 import logging
+import os
 import re
-import uhal
 import collections
+import random
+import socket
+import time
+
+from crappyhisto import LatencyStats
+from crappytrace import OPCODES
+from crappyaddrtab import register_list, addrtab_hash
+from crappyipc import default_ipc_path
+
+# zmq and uhal are imported where needed, they dominate the start-up time
+# of the command line tools.
+
+# Attempts of a wide read before giving up on a high word that keeps changing
+WIDE_RETRIES = 8
+# Suffixes of the low and high registers of the values split over two words
+WIDE_SUFFIXES = (('_l', '_h'), ('_lower', '_upper'))
+# Batch operations sent as [opcode, register id, val] when the server has the same table
+REG_OPCODES = {c: OPCODES[c] for c in ('read', 'write', 'wait')}
+TRANSPORTS = ('auto', 'inproc', 'ipc', 'tcp')
+# Client address of in-process requests in the flight recorder, 127.0.0.1
+LOCAL_CLIENT = 0x7f000001
+
+
+def is_local(host):
+    # No getfqdn(), its DNS lookup can take seconds
+    return host in ('localhost', '127.0.0.1') or host.split('.')[0] == socket.gethostname().split('.')[0]
+
+
+def server_listening(path):
+    """Whether a server accepts connections on the unix socket 'path', not just left it behind"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def select_transport(host, ipc_path=None):
+    """Fastest safe way to reach the hardware of 'host'
+
+    On the board itself: through the server unix socket 'ipc_path' when
+    the server runs, so that the read-modify-writes of all the tools are
+    serialized by the server. In-process when no server runs and /dev/mem
+    is accessible. tcp for remote boards, and as a last resort.
+    """
+    if not is_local(host):
+        return 'tcp'
+    if server_listening(ipc_path or default_ipc_path()):
+        return 'ipc'
+    if os.access('/dev/mem', os.R_OK | os.W_OK):
+        try:
+            import devmem
+            return 'inproc'
+        except ImportError:
+            pass
+    return 'tcp'
 
-uhal.setLogLevelTo(uhal.LogLevel.WARNING)
 
 class CrappyServerReplyTimeout(Exception):
     ""
     pass
 
+class CrappyServerError(Exception):
+    "Error reported by the server"
+    pass
+
 class CrappyRawHardwareClient:
 
-    def __init__(self, host: str, port: int):
+    # Operations per 'batch' request
+    BATCH_SIZE = 1024
+
+    def __init__(self, host: str, port: int, transport='auto', ipc_path=None):
         self.host = host
         self.port = port
+        self.transport = transport
+        # Same default as the server --ipc option
+        self.ipc_path = ipc_path or default_ipc_path()
         self.context = None
         self.socket = None
+        self._local = None
         self.timeout=1000
+        self.retries=3
+        self._caps = None
+        self._prepared = {}
+        self.stats = LatencyStats()
+        # Request ids are unique per client session
+        self._sid = random.getrandbits(31)
+        self._seq = 0
 
     def __del__(self):
         self.disconnect()
     
+    @property
+    def endpoint(self):
+        if self.transport == 'ipc':
+            return f"ipc://{self.ipc_path}"
+        return f"tcp://{self.host}:{self.port}"
+
     def connect(self):
-        self.context = zmq.Context()
+        if self.transport == 'auto':
+            self.transport = select_transport(self.host, self.ipc_path)
+
+        if self.transport == 'inproc':
+            # Requests are handled in this process, on our own mapping of
+            # the hardware. Accesses are not serialized with the server's.
+            if self._local is None:
+                from crappyhal import CrappyRawHardware
+                from crappyhal_srv import CrappyHalServer
+                self._local = CrappyHalServer(CrappyRawHardware(), log_every=0)
+            return
+
+        import zmq
+
+        if self.context is None:
+            self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect (f"tcp://{self.host}:{self.port}")
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.endpoint)
     
     def disconnect(self):
         if self.socket:
-            self.socket.disconnect(f"tcp://{self.host}:{self.port}")
+            self.socket.disconnect(self.endpoint)
 
+    def _reset_socket(self):
+        # A REQ socket that missed its reply cannot send again
+        self.socket.close()
+        CrappyRawHardwareClient.connect(self)
 
-    def read_addr(self, addr, mask):
 
-        req = {'cmd': 'read', 'addr': addr, 'mask': mask}
-        self.socket.send(json.dumps(req).encode())
-        if self.socket.poll(self.timeout, zmq.POLLIN):
-            message = self.socket.recv(zmq.NOBLOCK)
+    def _is_idempotent(self, req):
+        cmd = req['cmd']
+        if cmd == 'write':
+            return False
+        if cmd == 'batch':
+            return not any(op[0] in ('write', OPCODES['write']) for op in req['ops'])
+        if cmd == 'execute':
+            # A handle from another client may carry writes
+            p = self._prepared.get(req['handle'])
+            return p is not None and not any(op[0] in ('write', OPCODES['write']) for op in p.ops)
+        return True
+
+
+    def _request(self, req, timeout=None, deadline=None):
+        """Send a request and wait for its reply
+
+        Each attempt waits at most 'timeout' ms (self.timeout by default),
+        'deadline' (a time.monotonic() value) bounds the whole call.
+        After a lost reply the socket is reset. Idempotent requests are then
+        resent, up to self.retries times. Requests that modify the hardware
+        are resent only if the server deduplicates request ids: a resent
+        request is answered from the server reply cache if the original was
+        applied, executed otherwise.
+        """
+
+        if self._local is not None:
+            t0 = time.perf_counter()
+            rpl = self._local.handle(req, LOCAL_CLIENT)
+            self.stats.add('inproc', req['cmd'], time.perf_counter()-t0)
+            return rpl
+
+        retries = self.retries
+        if not self._is_idempotent(req):
+            if 'dedup' in self.caps:
+                self._seq += 1
+                req = dict(req, rid=(self._sid << 32) | self._seq)
+            else:
+                retries = 0
+
+        import zmq
+
+        cmd = req['cmd']
+        t0 = time.perf_counter()
+        message = json.dumps(req).encode()
+        t1 = time.perf_counter()
+
+        for attempt in range(retries+1):
+            wait = self.timeout if timeout is None else timeout
+            if deadline is not None:
+                remaining = max(0, int((deadline-time.monotonic())*1000))
+                wait = remaining if wait < 0 else min(wait, remaining)
+
+            t_send = time.perf_counter()
+            self.socket.send(message)
+            if self.socket.poll(wait, zmq.POLLIN):
+                reply = self.socket.recv(zmq.NOBLOCK)
+                break
+
+            self.stats.add('lost', cmd, time.perf_counter()-t_send)
+            logging.warning(f"No reply from {self.host} to '{cmd}' (attempt {attempt+1}/{retries+1})")
+            self._reset_socket()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise CrappyServerReplyTimeout(f"Deadline expired waiting for '{cmd}' reply from {self.host}")
         else:
-            raise CrappyServerReplyTimeout()
-        # message = self.socket.recv()
-        rpl = json.loads(message)
+            raise CrappyServerReplyTimeout(f"No reply to '{cmd}' from {self.host} after {retries+1} attempts")
+
+        t2 = time.perf_counter()
+        rpl = json.loads(reply)
+        t3 = time.perf_counter()
+
+        self.stats.add('encode', cmd, t1-t0)
+        self.stats.add('roundtrip', cmd, t2-t_send)
+        self.stats.add('decode', cmd, t3-t2)
+        return rpl
+
+
+    @property
+    def caps(self):
+        if self._caps is None:
+            # Servers predating 'caps' expect addr and mask in every request
+            rpl = self._request({'cmd': 'caps', 'addr': 0, 'mask': 0})
+            self._caps = set(rpl.get('caps', ['read', 'write']))
+        return self._caps
+
+
+    def read_addr(self, addr, mask, timeout=None):
+
+        req = {'cmd': 'read', 'addr': addr, 'mask': mask}
+        rpl = self._request(req, timeout)
         #print(f"Received reply {req} [{rpl}]")
         return int(rpl['read_val'], 0)
 
 
-    def write_addr(self, addr, mask, val):
+    def wait_addr(self, addr, mask, val, max_wait=1.0):
+        """Poll a register until it holds val, returning the last value read"""
+        t0 = time.monotonic()
+        while True:
+            v = self.read_addr(addr, mask)
+            if v == val or time.monotonic()-t0 > max_wait:
+                return v
+            time.sleep(1/1000)
+
+
+    def read_block(self, addr, n, timeout=None):
+
+        req = {'cmd': 'read_block', 'addr': addr, 'n': n}
+        rpl = self._request(req, timeout)
+        return rpl['read_vals']
+
+
+    def read_wide(self, lo_addr, hi_addr, timeout=None):
+        """Read a value split over a low and a high word, without tearing
+
+        The high word is read before and after the low one, the read is
+        retried if a carry changed it in between. Returns [low, high].
+        """
+        if 'read_wide' in self.caps:
+            rpl = self._request({'cmd': 'read_wide', 'addr': lo_addr, 'val': hi_addr}, timeout)
+            if 'read_vals' not in rpl:
+                raise CrappyServerError(rpl.get('error', 'Unexpected reply'))
+            return rpl['read_vals']
+
+        # Same sequence on older servers, one round trip per attempt at best
+        ops = [['read', hi_addr, 0xffffffff, 0], ['read', lo_addr, 0xffffffff, 0], ['read', hi_addr, 0xffffffff, 0]]
+        for _ in range(WIDE_RETRIES):
+            hi, lo, hi_again = self.batch(ops, timeout=timeout)
+            if hi == hi_again:
+                return [lo, hi]
+        raise CrappyServerError(f"High word {hex(hi_addr)} kept changing")
+
+
+    def flightrec(self, n=None):
+        """Fetch the last n records of the server flight recorder"""
+        rpl = self._request({'cmd': 'flightrec', 'n': n})
+        if 'flightrec' not in rpl:
+            raise CrappyServerError(rpl.get('error', 'Unexpected reply'))
+        return rpl['flightrec']
+
+
+    def server_stats(self, reset=False):
+        """Fetch the server latency histograms"""
+        rpl = self._request({'cmd': 'stats', 'reset': reset})
+        if 'stats' not in rpl:
+            raise CrappyServerError(rpl.get('error', 'Unexpected reply'))
+        return LatencyStats.from_dict(rpl['stats'])
+
+
+    def batch(self, ops, deadline=None, timeout=None):
+        """Execute a list of [cmd, addr, mask, val] operations
+
+        Operations are sent in batches of BATCH_SIZE when the server supports
+        it, one by one otherwise. Returns the values read, None for writes.
+        A 'wait' operation polls addr until it holds val, returning the last
+        value read.
+        'deadline' (seconds) bounds the execution of the whole list,
+        'timeout' (ms) each request.
+        """
+        if deadline is not None:
+            deadline = time.monotonic()+deadline
+
+        if 'batch' not in self.caps:
+            vals = []
+            for cmd, addr, mask, val in ops:
+                op_timeout = timeout
+                if deadline is not None:
+                    op_timeout = min(timeout or self.timeout, max(0, int((deadline-time.monotonic())*1000)))
+                if cmd == 'read':
+                    vals.append(self.read_addr(addr, mask, op_timeout))
+                elif cmd == 'wait':
+                    vals.append(self.wait_addr(addr, mask, val))
+                elif cmd == 'read_block':
+                    vals.append(self.read_block(addr, val, op_timeout))
+                elif cmd == 'read_wide':
+                    vals.append(self.read_wide(addr, val, op_timeout))
+                else:
+                    vals.append(self.write_addr(addr, mask, val, op_timeout))
+            return vals
+
+        vals = []
+        for i in range(0, len(ops), self.BATCH_SIZE):
+            rpl = self._send_ops('batch', ops[i:i+self.BATCH_SIZE], timeout, deadline)
+            if 'error' in rpl:
+                if 'batch_vals' not in rpl:
+                    # The request was rejected as a whole
+                    raise CrappyServerError(rpl['error'])
+                vals += rpl['batch_vals']
+                raise CrappyServerError(f"{rpl['error']} in operation {ops[len(vals)]}")
+            vals += rpl.get('batch_vals', [])
+        return vals
+
+
+    def _batch_request(self, ops):
+        return {'cmd': 'batch', 'ops': ops}
+
+
+    def _send_ops(self, cmd, ops, timeout=None, deadline=None, **keys):
+        """Send a request carrying an operation list ('batch' or 'prepare'), and 'keys'"""
+        return self._request(dict(self._batch_request(ops), cmd=cmd, **keys), timeout, deadline)
+
+
+    def prepare(self, ops, gap=0):
+        """Register a list of [cmd, addr, mask, val] operations on the server
+
+        The returned CrappyPrepared runs the list with a request carrying
+        only its handle. Servers without 'prepare' get the list as a batch.
+        The server merges reads of contiguous addresses into block reads,
+        'gap' lets a block also read up to that many words in between: only
+        for registers without read side effects.
+        """
+        p = CrappyPrepared(self, [list(op) for op in ops], gap)
+        self._register(p)
+        return p
+
+
+    def _register(self, p):
+        if 'prepare' not in self.caps:
+            return
+        keys = {'gap': p.gap} if p.gap else {}
+        rpl = self._send_ops('prepare', p.ops, **keys)
+        if 'handle' not in rpl:
+            raise CrappyServerError(rpl.get('error', 'Unexpected reply'))
+        p.handle = rpl['handle']
+        self._prepared[p.handle] = p
+
+
+    def execute(self, p, timeout=None, delta=False):
+        """Run a prepared operation list, returning the values as batch() does
+
+        With 'delta', the server only sends the values changed since the
+        previous delta execution of 'p', which are applied to p.vals. The
+        list returned is p.vals itself, updated in place.
+        """
+        if p.handle is None:
+            p.vals = self.batch(p.ops, timeout=timeout)
+            return p.vals
+
+        def request():
+            req = {'cmd': 'execute', 'handle': p.handle}
+            if delta and 'delta' in self.caps:
+                req['version'] = p.version
+            return self._request(req, timeout)
+
+        rpl = request()
+        if rpl.get('error') == 'UnknownHandle':
+            # Server restarted, or the list was evicted
+            self._register(p)
+            rpl = request()
+        if 'error' in rpl:
+            raise CrappyServerError(rpl['error'])
+
+        if 'delta' in rpl:
+            for i, v in rpl['delta']:
+                p.vals[i] = v
+        else:
+            p.vals = rpl['batch_vals']
+        p.version = rpl.get('version')
+        return p.vals
+
+
+    def write_addr(self, addr, mask, val, timeout=None):
         req = {'cmd': 'write', 'addr': addr, 'mask': mask, 'val': val}
-        self.socket.send(json.dumps(req).encode())
-        message = self.socket.recv()
-        # print(f"Received reply {req} [{message.decode('utf-8')}]")
+        rpl = self._request(req, timeout)
+        # print(f"Received reply {req} [{rpl}]")
+
+
+def load_addrtab(top_addrfile):
+    """Flatten a uhal address table into {name: {'addr': hex, 'mask': hex}}"""
+
+    import uhal
+    uhal.setLogLevelTo(uhal.LogLevel.WARNING)
+
+    # Create a dummy device to parse the address table
+    hw = uhal.getDevice('dummy', 'ipbusudp-2.0://127.0.0.1:50001', f'file://{top_addrfile}')
+    nodes = hw.getNodes()
+
+    flat_regmap = collections.OrderedDict()
+    for n in nodes:
+        flat_regmap[n] = {'addr':hex(hw.getNode(n).getAddress()), 'mask':hex(hw.getNode(n).getMask()) }   
+    return flat_regmap
+
+
+def _mask_shift(mask):
+    return (mask & -mask).bit_length()-1
+
+
+def wide_fields(addrtab):
+    """Fields split over a low and a high register, {name: (low, high)}
+
+    'x_l'/'x_h' and 'x_lower'/'x_upper' register pairs make a field 'x'.
+    When the high register has an 'upper' bitfield (the top 16 bits of the
+    MAC addresses) only that bitfield is part of the value.
+    """
+    fields = collections.OrderedDict()
+    for name in addrtab:
+        for lo_sfx, hi_sfx in WIDE_SUFFIXES:
+            if not name.endswith(lo_sfx):
+                continue
+            base = name[:-len(lo_sfx)]
+            hi = base+hi_sfx
+            if hi not in addrtab or base in addrtab:
+                continue
+            if hi+'.upper' in addrtab:
+                hi += '.upper'
+            fields[base] = (name, hi)
+    return fields
+
+
+class CrappyPrepared:
+    """Operation list registered on the server with CrappyRawHardwareClient.prepare"""
+
+    def __init__(self, hw, ops, gap=0):
+        self.hw = hw
+        self.ops = ops
+        self.gap = gap
+        self.handle = None
+        # Values of the last execution, and its version for delta executions
+        self.vals = None
+        self.version = None
+
+    def execute(self, timeout=None, delta=False):
+        return self.hw.execute(self, timeout, delta)
 
 
 class CrappyHardwareClient(CrappyRawHardwareClient):
 
-    def __init__(self, host, port, top_addrfile):
-        CrappyRawHardwareClient.__init__(self, host, port)
+    def __init__(self, host, port, top_addrfile, transport='auto', ipc_path=None):
+        CrappyRawHardwareClient.__init__(self, host, port, transport, ipc_path)
 
         # with open(top_addrfile, 'r') as f:
             # self._addrtab = json.load(f)
 
-        # Create a dummy device to parse the address table
-        hw = uhal.getDevice('dummy', 'ipbusudp-2.0://127.0.0.1:50001', f'file://{top_addrfile}')
-        nodes = hw.getNodes()
+        self.top_addrfile = top_addrfile
+        self._addrtab = self._load_addrtab()
+        self._wide = None
+        self._nodes = {}
+        self._reg_ids = None
+        self._trace = None
 
-        flat_regmap = collections.OrderedDict()
-        for n in nodes:
-            flat_regmap[n] = {'addr':hex(hw.getNode(n).getAddress()), 'mask':hex(hw.getNode(n).getMask()) }   
-        self._addrtab = flat_regmap
+    def _load_addrtab(self):
+        return load_addrtab(self.top_addrfile)
 
     @property
     def addrtab(self):
 
         return self._addrtab
 
+    def connect(self):
+        CrappyRawHardwareClient.connect(self)
+        self.hello()
+
+    def hello(self):
+        """Check the address table of the server against ours
+
+        If the server loaded the same table, batches address its registers
+        by id. A server with a different table rejects the client.
+        """
+        h = addrtab_hash(self._addrtab)
+        rpl = self._request({'cmd': 'hello', 'hash': h})
+        if rpl.get('error') == 'AddrtabMismatch':
+            raise CrappyServerError(f"{self.host} runs with address table {rpl['hash']}, this client with {h}")
+        if 'caps' not in rpl:
+            # Server predating the handshake
+            return
+
+        self._caps = set(rpl['caps'])
+        if rpl['hash'] == h:
+            # Registers sharing addr and mask are interchangeable
+            self._reg_ids = {}
+            for i, (_, addr, mask) in enumerate(register_list(self._addrtab)):
+                self._reg_ids.setdefault((addr, mask), i)
+            self._addrtab_hash = h
+
+    def _send_ops(self, cmd, ops, timeout=None, deadline=None, **keys):
+        rpl = CrappyRawHardwareClient._send_ops(self, cmd, ops, timeout, deadline, **keys)
+        if rpl.get('error') == 'AddrtabMismatch' and self._reg_ids is not None:
+            # The server restarted with another table, or none. The request
+            # was rejected as a whole, check the table again and resend.
+            self._reg_ids = None
+            self.hello()
+            rpl = CrappyRawHardwareClient._send_ops(self, cmd, ops, timeout, deadline, **keys)
+        return rpl
+
+    def _batch_request(self, ops):
+        if self._reg_ids is None:
+            return CrappyRawHardwareClient._batch_request(self, ops)
+
+        ids = self._reg_ids
+        enc = []
+        for op in ops:
+            cmd, addr, mask, val = op
+            rid = ids.get((addr, mask)) if cmd in REG_OPCODES else None
+            if rid is None:
+                enc.append(op)
+            elif cmd == 'read':
+                enc.append([REG_OPCODES[cmd], rid])
+            else:
+                enc.append([REG_OPCODES[cmd], rid, int(val)])
+        return {'cmd': 'batch', 'ops': enc, 'hash': self._addrtab_hash}
+
+    @property
+    def wide_fields(self):
+        if self._wide is None:
+            self._wide = wide_fields(self._addrtab)
+        return self._wide
+
+    def node(self, path):
+        """Handle on the subtree at 'path', see CrappyNode"""
+        n = self._nodes.get(path)
+        if n is None:
+            n = self._nodes[path] = CrappyNode(self, path)
+        return n
+
+    def merge_wide(self, names):
+        """Replace the low/high register pairs in 'names' by their wide field"""
+        present = set(names)
+        fields = {}
+        skip = set()
+        for f, (lo, hi) in self.wide_fields.items():
+            if lo in present and hi in present:
+                fields[lo] = f
+                # The high register and its bitfields, wherever they sort
+                hi_reg = hi[:-len('.upper')] if hi.endswith('.upper') else hi
+                skip.update(r for r in names if r == hi_reg or r.startswith(hi_reg+'.'))
+
+        return [fields.get(n, n) for n in names if n not in skip]
+
+    def start_recording(self):
+        """Start recording the operations sent to the hardware"""
+        self._trace = []
+
+    def stop_recording(self):
+        """Stop recording, returning the recorded [cmd, addr, mask, val] operations"""
+        trace, self._trace = self._trace, None
+        return trace
+
+    def read_addr(self, addr, mask, timeout=None):
+        if self._trace is not None:
+            self._trace.append(['read', addr, mask, 0])
+        return CrappyRawHardwareClient.read_addr(self, addr, mask, timeout)
+
+    def read_block(self, addr, n, timeout=None):
+        if self._trace is not None:
+            self._trace.append(['read_block', addr, 0xffffffff, n])
+        return CrappyRawHardwareClient.read_block(self, addr, n, timeout)
+
+    def read_wide(self, lo_addr, hi_addr, timeout=None):
+        # Record the wide read, not the batch it may fall back to
+        trace, self._trace = self._trace, None
+        try:
+            if trace is not None:
+                trace.append(['read_wide', lo_addr, 0xffffffff, hi_addr])
+            return CrappyRawHardwareClient.read_wide(self, lo_addr, hi_addr, timeout)
+        finally:
+            self._trace = trace
+
+    def write_addr(self, addr, mask, val, timeout=None):
+        if self._trace is not None:
+            self._trace.append(['write', addr, mask, int(val)])
+        return CrappyRawHardwareClient.write_addr(self, addr, mask, val, timeout)
+
+    def batch(self, ops, deadline=None, timeout=None):
+        # Record the batch as a whole, not the operations it may fall back to
+        trace, self._trace = self._trace, None
+        try:
+            if trace is not None:
+                trace += [list(op) for op in ops]
+            return CrappyRawHardwareClient.batch(self, ops, deadline, timeout)
+        finally:
+            self._trace = trace
+
+    def execute(self, p, timeout=None, delta=False):
+        # Record the operations of the list, not the batch it may fall back to
+        trace, self._trace = self._trace, None
+        try:
+            if trace is not None:
+                trace += [list(op) for op in p.ops]
+            return CrappyRawHardwareClient.execute(self, p, timeout, delta)
+        finally:
+            self._trace = trace
+
+    def board_info(self):
+        """Check the magic number and read the firmware generics"""
+        magic = self.read('tx.info.magic')
+        if magic != 0xdeadbeef:
+            raise ValueError(f"Magic number check failed. Expected '0xdeadbeef', read '{hex(magic)}'")
+
+        return {
+            'n_mgt': self.read('tx.info.generics.n_mgts'),
+            'n_src': self.read('tx.info.generics.n_srcs'),
+            'ref_freq': self.read('tx.info.generics.ref_freq'),
+        }
+
     def get_regs(self, regex):
         exp = re.compile(regex)
         
@@ -88,6 +637,8 @@ class CrappyHardwareClient(CrappyRawHardwareClient):
 
     def read(self, name):
         if not name in self._addrtab:
+            if name in self.wide_fields:
+                return self.read_wide_field(name)
             raise ValueError('Unknown register '+name)
         
         addr = int(self._addrtab[name]['addr'],0)
@@ -99,6 +650,42 @@ class CrappyHardwareClient(CrappyRawHardwareClient):
 
 
 
+    def read_wide_field(self, name):
+        """Read a field spanning two registers in a single consistent read"""
+        lo, hi = self.wide_fields[name]
+        lo_val, hi_val = self.read_wide(int(self._addrtab[lo]['addr'],0), int(self._addrtab[hi]['addr'],0))
+        return self.combine_wide(name, lo_val, hi_val)
+
+    def read_ops(self, names):
+        """Batch operations reading the registers or wide fields 'names'"""
+        wide = self.wide_fields
+        ops = []
+        for n in names:
+            if n in wide:
+                lo, hi = (self._addrtab[r] for r in wide[n])
+                ops.append(['read_wide', int(lo['addr'], 0), 0xffffffff, int(hi['addr'], 0)])
+            else:
+                ops.append(['read', int(self._addrtab[n]['addr'], 0), int(self._addrtab[n]['mask'], 0), 0])
+        return ops
+
+    def read_vals(self, names, vals):
+        """{name: val} from the values returned for read_ops(names)"""
+        wide = self.wide_fields
+        return collections.OrderedDict(
+            (n, self.combine_wide(n, *v) if n in wide else v) for n, v in zip(names, vals)
+        )
+
+    def combine_wide(self, name, lo_val, hi_val):
+        """Value of the wide field 'name' from its raw low and high words"""
+        lo, hi = self.wide_fields[name]
+        lo_mask = int(self._addrtab[lo]['mask'],0)
+        hi_mask = int(self._addrtab[hi]['mask'],0)
+
+        lo_val = (lo_val & lo_mask) >> _mask_shift(lo_mask)
+        hi_val = (hi_val & hi_mask) >> _mask_shift(hi_mask)
+        return lo_val | (hi_val << bin(lo_mask).count('1'))
+
+
     def write(self, name, val):
         if not name in self._addrtab:
             raise ValueError('Unknown register '+name)
@@ -109,3 +696,69 @@ class CrappyHardwareClient(CrappyRawHardwareClient):
         return self.write_addr(addr, mask, val)
 
 
+class CrappyNode:
+    """Handle on a subtree of the address table
+
+    The registers below 'path' are resolved once to (addr, mask)
+    descriptors, accesses through the handle use relative names and skip
+    the name lookups and conversions of CrappyHardwareClient.read/write.
+    """
+
+    def __init__(self, hw, path):
+        self.hw = hw
+        self.path = path
+
+        prefix = path+'.'
+        self._regs = collections.OrderedDict(
+            (n[len(prefix):], (int(d['addr'], 0), int(d['mask'], 0)))
+            for n, d in hw.addrtab.items() if n.startswith(prefix)
+        )
+        if not self._regs:
+            raise ValueError('Unknown node '+path)
+
+    def __repr__(self):
+        return f"CrappyNode('{self.path}')"
+
+    def names(self):
+        return list(self._regs)
+
+    def node(self, name):
+        return self.hw.node(f'{self.path}.{name}')
+
+    def descr(self, name):
+        """(addr, mask) of the register 'name', relative to the node"""
+        try:
+            return self._regs[name]
+        except KeyError:
+            raise ValueError(f'Unknown register {self.path}.{name}') from None
+
+    def read(self, name):
+        addr, mask = self.descr(name)
+        return self.hw.read_addr(addr, mask)
+
+    def write(self, name, val):
+        addr, mask = self.descr(name)
+        return self.hw.write_addr(addr, mask, val)
+
+    def write_ops(self, vals):
+        """Batch operations writing {name: val}, in order"""
+        return [['write', *self.descr(n), int(v)] for n, v in vals.items()]
+
+    def write_many(self, vals):
+        """Write {name: val} in order, in a single batch"""
+        self.hw.batch(self.write_ops(vals))
+
+    def read_all(self, regex=None):
+        """Read the registers of the subtree, or those matching 'regex', in a single batch
+
+        Values split over two registers are read consistently, as one wide
+        field. Returns {name: val} with names relative to the node.
+        """
+        exp = re.compile(regex) if regex is not None else None
+        prefix = self.path+'.'
+        names = self.hw.merge_wide([prefix+n for n in self._regs if exp is None or exp.match(n)])
+
+        vals = self.hw.batch(self.hw.read_ops(names))
+        return collections.OrderedDict(
+            (n[len(prefix):], v) for n, v in self.hw.read_vals(names, vals).items()
+        )
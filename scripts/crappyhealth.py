@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+import collections
+import time
+import click
+import numpy as np
+
+from crappybutler import CrappyObj, ctrl_hosts
+
+# Registers sampled once per link, '{link}' is replaced by the link number
+LINK_FIELDS = collections.OrderedDict([
+    ('magic', 'tx.info.magic'),
+    ('en', 'tx.mux.csr.ctrl.en'),
+    ('en_buf', 'tx.mux.csr.ctrl.en_buf'),
+    ('tx_en', 'tx.mux.csr.ctrl.tx_en'),
+    ('err', 'tx.mux.csr.stat.err'),
+    ('eth_rdy', 'tx.mux.csr.stat.eth_rdy'),
+    ('udp_rdy', 'tx.mux.csr.stat.udp_rdy'),
+    ('mux_oflow', 'tx.mux.mux.stat.oflow'),
+    ('udp_count', 'tx.udp.udp_core_{link}.udp_core_control.packet_counters.udp_count'),
+    ('dropped_ip', 'tx.udp.udp_core_{link}.udp_core_control.packet_counters.dropped_ip_count'),
+    ('dropped_mac', 'tx.udp.udp_core_{link}.udp_core_control.packet_counters.dropped_mac_count'),
+    ('dropped_port', 'tx.udp.udp_core_{link}.udp_core_control.packet_counters.dropped_port_count'),
+])
+
+# Registers sampled once per buffer of each link
+BUF_FIELDS = collections.OrderedDict([
+    ('fake_en', 'tx.mux.buf.ctrl.fake_en'),
+    ('rx_stat', 'tx.mux.buf.stat.rx_stat'),
+    ('tx_stat', 'tx.mux.buf.stat.tx_stat'),
+    ('blk_acc', 'tx.mux.buf.blk_acc'),
+    ('blk_rej', 'tx.mux.buf.blk_rej'),
+    ('blk_oflow', 'tx.mux.buf.blk_oflow'),
+    ('vol', 'tx.mux.buf.vol'),
+])
+
+SEVERITIES = ('info', 'warning', 'error', 'critical')
+
+# Checks:
+#   'ne': field differs from 'value'
+#   'nonzero': field is not zero
+#   'grows': field increased since the previous sample
+#   'on_while_off': buffer field set while the link field 'gate' is not
+RULES = [
+    {'name': 'magic', 'severity': 'critical', 'check': 'ne', 'field': 'magic', 'value': 0xdeadbeef,
+     'message': 'Magic number mismatch'},
+    {'name': 'link_error', 'severity': 'error', 'check': 'nonzero', 'field': 'err',
+     'message': 'Link in error'},
+    {'name': 'mux_overflow', 'severity': 'error', 'check': 'nonzero', 'field': 'mux_oflow',
+     'message': 'Mux overflow'},
+    {'name': 'buf_overflow', 'severity': 'error', 'check': 'grows', 'field': 'blk_oflow',
+     'message': 'Buffer overflowed blocks'},
+    {'name': 'buf_rejected', 'severity': 'warning', 'check': 'grows', 'field': 'blk_rej',
+     'message': 'Buffer rejected blocks'},
+    {'name': 'udp_drop_ip', 'severity': 'warning', 'check': 'grows', 'field': 'dropped_ip',
+     'message': 'UDP packets dropped (ip)'},
+    {'name': 'udp_drop_mac', 'severity': 'warning', 'check': 'grows', 'field': 'dropped_mac',
+     'message': 'UDP packets dropped (mac)'},
+    {'name': 'udp_drop_port', 'severity': 'warning', 'check': 'grows', 'field': 'dropped_port',
+     'message': 'UDP packets dropped (port)'},
+    {'name': 'src_while_tx_off', 'severity': 'warning', 'check': 'on_while_off', 'field': 'fake_en', 'gate': 'tx_en',
+     'message': 'Source enabled while the link transmitter is off'},
+]
+
+Alarm = collections.namedtuple('Alarm', ['severity', 'rule', 'host', 'link', 'buf', 'value', 'message'])
+
+
+class HealthSample:
+    """Link and buffer fields of one or more boards
+
+    'link' is a (n_links, n_link_fields) array, 'buf' a (n_links, n_bufs,
+    n_buf_fields) one. The links of several boards are stacked along the
+    first axis, 'hosts' and 'links' identify each row.
+    """
+
+    def __init__(self, t, hosts, links, link, buf):
+        self.time = t
+        self.hosts = hosts
+        self.links = links
+        self.link = link
+        self.buf = buf
+
+    @classmethod
+    def stack(cls, samples):
+        """Stack the samples of several boards, padding the buffer axis with zeros"""
+        n_bufs = max(s.buf.shape[1] for s in samples)
+        bufs = [np.pad(s.buf, ((0, 0), (0, n_bufs-s.buf.shape[1]), (0, 0))) for s in samples]
+        return cls(
+            max(s.time for s in samples),
+            [h for s in samples for h in s.hosts],
+            [l for s in samples for l in s.links],
+            np.concatenate([s.link for s in samples]),
+            np.concatenate(bufs),
+        )
+
+
+class HealthReader:
+    """Samples the health fields of one board in a single prepared request"""
+
+    def __init__(self, hw, host, n_links, n_bufs):
+        self.hw = hw
+        self.host = host
+        self.n_links = n_links
+        self.n_bufs = n_bufs
+
+        ops = []
+        self._link_names = []
+        self._buf_names = []
+        self._link_pos = []
+        self._buf_pos = []
+        for i in range(n_links):
+            ops += hw.node('tx.csr.ctrl').write_ops({'sel': i})
+            names = [r.format(link=i) for r in LINK_FIELDS.values()]
+            self._link_names.append(names)
+            self._link_pos.append(len(ops))
+            ops += hw.read_ops(names)
+
+            for j in range(n_bufs):
+                ops += hw.node('tx.mux.csr.ctrl').write_ops({'sel_buf': j})
+                names = list(BUF_FIELDS.values())
+                self._buf_names.append(names)
+                self._buf_pos.append(len(ops))
+                ops += hw.read_ops(names)
+
+        self._prep = hw.prepare(ops)
+
+    def read(self, delta=False):
+        # With delta the server sends only the values changed since the last read
+        vals = self._prep.execute(delta=delta)
+        t = time.time()
+
+        n_lf = len(LINK_FIELDS)
+        n_bf = len(BUF_FIELDS)
+        link = np.array([
+            list(self.hw.read_vals(names, vals[p:p+n_lf]).values())
+            for names, p in zip(self._link_names, self._link_pos)
+        ], dtype=np.uint64).reshape(self.n_links, n_lf)
+        buf = np.array([
+            list(self.hw.read_vals(names, vals[p:p+n_bf]).values())
+            for names, p in zip(self._buf_names, self._buf_pos)
+        ], dtype=np.uint64).reshape(self.n_links, self.n_bufs, n_bf)
+
+        return HealthSample(t, [self.host]*self.n_links, list(range(self.n_links)), link, buf)
+
+
+def _field(sample, name):
+    """Values of a field, (n_links,) or (n_links, n_bufs), and whether it is per buffer"""
+    if name in LINK_FIELDS:
+        return sample.link[:, list(LINK_FIELDS).index(name)], False
+    return sample.buf[:, :, list(BUF_FIELDS).index(name)], True
+
+
+def evaluate(sample, prev=None, rules=RULES):
+    """Evaluate the rules over a sample, returning the alarms raised
+
+    'grows' rules need the previous sample of the same boards and are
+    skipped without it.
+    """
+    alarms = []
+    for r in rules:
+        cur, per_buf = _field(sample, r['field'])
+        check = r['check']
+
+        if check == 'ne':
+            hit = cur != r['value']
+        elif check == 'nonzero':
+            hit = cur != 0
+        elif check == 'grows':
+            if prev is None:
+                continue
+            hit = cur > _field(prev, r['field'])[0]
+        elif check == 'on_while_off':
+            gate, _ = _field(sample, r['gate'])
+            hit = (cur != 0) & (gate == 0)[:, None]
+        else:
+            raise ValueError(f"Unknown check '{check}' in rule '{r['name']}'")
+
+        for idx in zip(*np.nonzero(hit)):
+            row = idx[0]
+            alarms.append(Alarm(
+                r['severity'], r['name'], sample.hosts[row], sample.links[row],
+                int(idx[1]) if per_buf else None, int(cur[idx]), r['message']
+            ))
+
+    alarms.sort(key=lambda a: -SEVERITIES.index(a.severity))
+    return alarms
+
+
+def alarms_to_table(alarms, **kwargs):
+    # rich is not needed to evaluate the rules
+    from rich.table import Table
+
+    styles = {'info': 'blue', 'warning': 'yellow', 'error': 'red', 'critical': 'bold red'}
+    t = Table(**kwargs)
+    for c in ('severity', 'rule', 'host', 'link', 'buf', 'value', 'message'):
+        t.add_column(c)
+    for a in alarms:
+        t.add_row(
+            f"[{styles[a.severity]}]{a.severity}[/]", a.rule, a.host, str(a.link),
+            '' if a.buf is None else str(a.buf), hex(a.value), a.message
+        )
+    return t
+
+
+@click.command()
+@click.argument('ctrl_ids', type=click.Choice(ctrl_hosts), nargs=-1, required=True)
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between the two samples compared')
+@click.option('-n', '--passes', type=int, default=1, help='Number of comparisons, 0 to run until interrupted')
+def main(ctrl_ids, interval, passes):
+    """Check the health of a set of boards"""
+    from rich import print
+
+    readers = []
+    for c in ctrl_ids:
+        obj = CrappyObj(c, use_agent=None, record=None)
+        readers.append(HealthReader(obj.hw, c, obj.n_mgt, obj.n_src//obj.n_mgt))
+
+    prev = HealthSample.stack([r.read() for r in readers])
+    n = 0
+    try:
+        while not passes or n < passes:
+            time.sleep(interval)
+            cur = HealthSample.stack([r.read() for r in readers])
+            alarms = evaluate(cur, prev)
+            print(alarms_to_table(alarms, title=f"Health {time.strftime('%H:%M:%S')}: {len(alarms)} alarms"))
+            prev = cur
+            n += 1
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
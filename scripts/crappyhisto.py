@@ -0,0 +1,105 @@
+# Bucket i counts latencies in [2**(i-1), 2**i) us, the last one everything above
+N_BUCKETS = 24
+
+
+class LatencyHistogram:
+    """Fixed log2-bucket latency histogram"""
+
+    def __init__(self):
+        self.counts = [0]*N_BUCKETS
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, dt):
+        us = int(dt*1e6)
+        self.counts[min(us.bit_length(), N_BUCKETS-1)] += 1
+        self.n += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def merge(self, other):
+        self.counts = [a+b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total/self.n if self.n else 0.
+
+    def percentile(self, p):
+        """Upper edge of the bucket containing the p-th percentile, in seconds"""
+        if not self.n:
+            return 0.
+        target = self.n*p/100.
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= target:
+                return min((1 << i)*1e-6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'counts': self.counts, 'n': self.n, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        h.counts = list(d['counts'])
+        h.n = d['n']
+        h.total = d['total']
+        h.max = d['max']
+        return h
+
+
+class LatencyStats:
+    """Latency histograms indexed by (stage, operation)"""
+
+    def __init__(self):
+        self.histos = {}
+
+    def add(self, stage, op, dt):
+        h = self.histos.get((stage, op))
+        if h is None:
+            h = self.histos[(stage, op)] = LatencyHistogram()
+        h.add(dt)
+
+    def merge(self, other, prefix=''):
+        for (stage, op), h in other.histos.items():
+            key = (prefix+stage, op)
+            if key not in self.histos:
+                self.histos[key] = LatencyHistogram()
+            self.histos[key].merge(h)
+
+    def reset(self):
+        self.histos = {}
+
+    def to_dict(self):
+        return {f'{stage}:{op}': h.to_dict() for (stage, op), h in self.histos.items()}
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls()
+        for k, h in d.items():
+            stage, op = k.split(':', 1)
+            s.histos[(stage, op)] = LatencyHistogram.from_dict(h)
+        return s
+
+    def to_table(self, **kwargs):
+        # rich is not installed on the boards
+        from rich.table import Table
+
+        t = Table(**kwargs)
+        t.add_column('stage')
+        t.add_column('op')
+        t.add_column('count', style='cyan')
+        for c in ('mean', 'p50', 'p99', 'max'):
+            t.add_column(f'{c} (us)', style='green')
+        for (stage, op), h in sorted(self.histos.items()):
+            t.add_row(
+                stage, op, str(h.n),
+                *(f'{v*1e6:.1f}' for v in (h.mean, h.percentile(50), h.percentile(99), h.max))
+            )
+        return t
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import subprocess
+import click
+
+# Import time budget of the command line tools, in ms
+BUDGETS = {
+    'crappybutler': 100,
+    'crappystats': 100,
+    'crappyfreq': 100,
+}
+
+# Modules that must not be loaded just by importing a command line tool
+HEAVY = ('zmq', 'uhal', 'rich', 'numpy')
+
+
+def import_time(module):
+    """Import 'module' in a fresh interpreter, returning the cumulative
+    import times (us) of all the modules loaded"""
+
+    env = dict(os.environ)
+    # The tools must be importable without the environment of a board session
+    env.pop('CRAPPYZCU_SHARE', None)
+    p = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        capture_output=True, text=True
+    )
+    if p.returncode:
+        raise click.ClickException(f"Failed to import {module}:\n{p.stderr}")
+
+    times = {}
+    for l in p.stderr.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', l)
+        if m:
+            times[m.group(3)] = int(m.group(1))
+    return times
+
+
+@click.command()
+@click.option('-s', '--scale', type=float, default=1., help='Scale the budgets, for slow machines')
+@click.argument('modules', nargs=-1)
+def main(scale, modules):
+    """Check the import time of the command line tools against their budget"""
+
+    failed = False
+    for mod in (modules or BUDGETS):
+        times = import_time(mod)
+        ms = times[mod]/1e3
+        budget = BUDGETS.get(mod, 100)*scale
+        heavy = sorted(m for m in times if m.split('.')[0] in HEAVY)
+
+        ok = ms <= budget and not heavy
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {mod}: {ms:.1f} ms (budget {budget:.0f} ms)")
+        if heavy:
+            print(f"     loads {', '.join(heavy)}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
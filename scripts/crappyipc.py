@@ -0,0 +1,9 @@
+import os
+
+# Unix socket the server listens on besides tcp, for the clients on the board
+IPC_PATH = '/tmp/crappyhal.sock'
+
+
+def default_ipc_path():
+    """Server unix socket, CRAPPYHAL_SOCKET overrides the default for the server and the clients"""
+    return os.environ.get('CRAPPYHAL_SOCKET') or IPC_PATH
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import click
+from rich import print
+
+from crappyhalclient import CrappyRawHardwareClient
+from crappyhisto import LatencyStats
+
+port = 5556
+
+@click.command()
+@click.argument('ctrl_ids', nargs=-1, required=True)
+@click.option('-p', '--probe', type=int, default=0, help='Issue N single reads and a batch of N reads before fetching the histograms')
+@click.option('-r', '--reset', is_flag=True, default=False, help='Reset the server histograms after fetching them')
+@click.option('--per-host', is_flag=True, default=False, help='Show the histograms of each host, not only the merged ones')
+def main(ctrl_ids, probe, reset, per_host):
+    """Fetch and merge the latency histograms of crappyhal servers"""
+
+    merged = LatencyStats()
+    for ctrl_id in ctrl_ids:
+        hw = CrappyRawHardwareClient(ctrl_id, port)
+        hw.connect()
+
+        if probe:
+            for _ in range(probe):
+                hw.read_addr(0x0, 0xffffffff)
+            hw.batch([['read', 0x0, 0xffffffff, 0]]*probe)
+
+        srv_stats = hw.server_stats(reset)
+
+        host_stats = LatencyStats()
+        host_stats.merge(hw.stats, 'client.')
+        host_stats.merge(srv_stats, 'server.')
+        if per_host:
+            print(host_stats.to_table(title=ctrl_id))
+        merged.merge(host_stats)
+
+    print(merged.to_table(title=f"Latencies ({', '.join(ctrl_ids)})"))
+
+
+if __name__ == '__main__':
+    main()
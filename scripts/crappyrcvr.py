@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+import collections
+import multiprocessing
+import queue
+import socket
+import time
+import click
+import numpy as np
+
+from crappybutler import rx_endpoints, tx_endpoints
+
+# DAQEthHeader, two little-endian 64-bit words. The first one is
+#   version:6 det_id:6 crate_id:10 slot_id:4 stream_id:8 reserved:6 seq_id:12 block_length:12
+# the second one the timestamp.
+HEADER_BYTES = 16
+SRC_MASK = ((1 << 34)-1) & ~0x3f
+SEQ_SHIFT = 40
+SEQ_MOD = 1 << 12
+
+# dlen counts 64-bit payload words
+DLEN_BYTES = 8
+
+MAX_PKT = 9000
+BATCH = 256
+
+# Per source counters
+COUNTERS = ('packets', 'bytes', 'lost', 'out_of_order', 'bad_size')
+
+
+def source_fields(key):
+    """(det, crate, slot, stream) of a source key"""
+    return (key >> 6) & 0x3f, (key >> 12) & 0x3ff, (key >> 22) & 0xf, (key >> 26) & 0xff
+
+
+class StreamStats:
+    """Per source and per sender counters of the packets received by one worker
+
+    Counters accumulate until taken, the last sequence id of each source
+    is kept across takes to count the gaps.
+    """
+
+    def __init__(self, dlen=None):
+        self.expected = None if dlen is None else HEADER_BYTES+dlen*DLEN_BYTES
+        self.last_seq = {}
+        self.reset()
+
+    def reset(self):
+        self.sources = {}
+        self.senders = collections.Counter()
+        self.sender_bytes = collections.Counter()
+        self.runts = 0
+
+    def add_sender(self, addr, n):
+        self.senders[addr] += 1
+        self.sender_bytes[addr] += n
+
+    def add_batch(self, buf, lens):
+        """Count the 'lens' packets received in the rows of 'buf'"""
+        ok = lens >= HEADER_BYTES
+        self.runts += int((~ok).sum())
+
+        word0 = buf[:, :HEADER_BYTES].view('<u8')[ok, 0]
+        lens = lens[ok]
+        keys = word0 & SRC_MASK
+        seqs = ((word0 >> SEQ_SHIFT) % SEQ_MOD).astype(np.int64)
+        bad = lens != self.expected if self.expected is not None else np.zeros(len(lens), dtype=bool)
+
+        # Packets of each source, in arrival order
+        order = np.argsort(keys, kind='stable')
+        keys, seqs, lens, bad = keys[order], seqs[order], lens[order], bad[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        # Sequence ids skipped between consecutive packets
+        gaps = (seqs[1:]-seqs[:-1]-1) % SEQ_MOD
+
+        for s, e in zip(starts, ends):
+            k = int(keys[s])
+            g = gaps[s:e-1]
+            last = self.last_seq.get(k)
+            if last is not None:
+                g = np.r_[(seqs[s]-last-1) % SEQ_MOD, g]
+            # A packet older than the previous one wraps around to a huge gap
+            late = g >= SEQ_MOD//2
+            if late.any():
+                # Gaps are counted from the last packet in order, not from a late one
+                lost, n_late, last = self._count_late(seqs[s:e], last)
+            else:
+                lost, n_late, last = int(g.sum()), 0, int(seqs[e-1])
+
+            c = self.sources.setdefault(k, [0]*len(COUNTERS))
+            c[0] += int(e-s)
+            c[1] += int(lens[s:e].sum())
+            c[2] += lost
+            c[3] += n_late
+            c[4] += int(bad[s:e].sum())
+            self.last_seq[k] = last
+
+    @staticmethod
+    def _count_late(seqs, last):
+        """(lost, late, last in order sequence id) of the packets of a source, one by one"""
+        lost = n_late = 0
+        for q in seqs.tolist():
+            if last is not None:
+                g = (q-last-1) % SEQ_MOD
+                if g >= SEQ_MOD//2:
+                    n_late += 1
+                    continue
+                lost += g
+            last = q
+        return lost, n_late, last
+
+    def take(self):
+        """Counters accumulated since the previous take"""
+        d = {
+            'sources': self.sources,
+            'senders': dict(self.senders),
+            'sender_bytes': dict(self.sender_bytes),
+            'runts': self.runts,
+        }
+        self.reset()
+        return d
+
+
+def receive(bind, port, dlen, interval, seconds, rcvbuf, results):
+    """Worker receiving on (bind, port), putting its counters on 'results' every 'interval' seconds
+
+    The last counters are followed by None, after 'seconds' (0 for no
+    limit) or an interrupt.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # The kernel spreads the flows, i.e. the board links, over the workers
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((bind, port))
+    sock.settimeout(min(interval, 0.1))
+
+    buf = np.zeros((BATCH, MAX_PKT), dtype=np.uint8)
+    slots = [memoryview(buf[i]) for i in range(BATCH)]
+    lens = np.zeros(BATCH, dtype=np.int64)
+    stats = StreamStats(dlen)
+
+    t0 = time.time()
+    next_report = t0+interval
+    try:
+        while not seconds or time.time()-t0 < seconds:
+            # Block for the first packet, then drain what is queued without blocking
+            n = 0
+            try:
+                nbytes, addr = sock.recvfrom_into(slots[0])
+                lens[0] = nbytes
+                stats.add_sender(addr[0], nbytes)
+                n = 1
+                while n < BATCH:
+                    nbytes, addr = sock.recvfrom_into(slots[n], MAX_PKT, socket.MSG_DONTWAIT)
+                    lens[n] = nbytes
+                    stats.add_sender(addr[0], nbytes)
+                    n += 1
+            except (BlockingIOError, socket.timeout):
+                pass
+
+            if n:
+                stats.add_batch(buf[:n], lens[:n])
+
+            if time.time() >= next_report:
+                results.put(stats.take())
+                next_report += interval
+    except KeyboardInterrupt:
+        pass
+
+    results.put(stats.take())
+    results.put(None)
+
+
+def sender_name(ip):
+    """Name of the tx endpoint with address 'ip', the address itself if unknown"""
+    for name, ep in tx_endpoints.items():
+        if socket.inet_ntoa(ep['ip'].to_bytes(4, 'big')) == ip:
+            return f"{name} ({ip})"
+    return ip
+
+
+class StreamTotals:
+    """Counters merged over the workers, and over the last interval for the rates"""
+
+    def __init__(self):
+        self.total = {}
+        self.recent = {}
+        self.senders = collections.Counter()
+        self.sender_bytes = collections.Counter()
+        self.runts = 0
+
+    def merge(self, d):
+        for k, c in d['sources'].items():
+            for acc in (self.total, self.recent):
+                a = acc.setdefault(k, [0]*len(COUNTERS))
+                for i, v in enumerate(c):
+                    a[i] += v
+        self.senders.update(d['senders'])
+        self.sender_bytes.update(d['sender_bytes'])
+        self.runts += d['runts']
+
+    def tables(self, dt):
+        from rich.table import Table
+
+        t = Table(title='sources')
+        for c in ('det', 'crate', 'slot', 'stream', *COUNTERS, 'pkt/s', 'bytes/s'):
+            t.add_column(c)
+        for k in sorted(self.total):
+            c = self.total[k]
+            r = self.recent.get(k, [0]*len(COUNTERS))
+            t.add_row(
+                *(str(v) for v in source_fields(k)), *(str(v) for v in c),
+                f'{r[0]/dt:.1f}', f'{r[1]/dt:.3e}'
+            )
+
+        s = Table(title=f'senders ({self.runts} runt packets)')
+        for c in ('sender', 'packets', 'bytes'):
+            s.add_column(c)
+        for ip in sorted(self.senders):
+            # hex as in the board packet_counters
+            s.add_row(sender_name(ip), f'{self.senders[ip]} ({hex(self.senders[ip])})', str(self.sender_bytes[ip]))
+
+        self.recent = {}
+        return t, s
+
+
+@click.command()
+@click.option('-e', '--endpoint', type=click.Choice(rx_endpoints.keys()), default=None, help='Receive on the address of this endpoint (default: all addresses)')
+@click.option('-p', '--port', type=int, default=0x4444)
+@click.option('-w', '--workers', type=int, default=1, help='Receiving processes sharing the port, one flow (board link) is handled by a single one')
+@click.option('-d', '--dlen', type=click.IntRange(0, 0xfff), default=None, help='Expected dlen, packets of another size are counted')
+@click.option('-i', '--interval', type=float, default=1., help='Seconds between reports')
+@click.option('-s', '--seconds', type=float, default=0, help='Stop after this many seconds, 0 to run until interrupted')
+@click.option('--rcvbuf', type=int, default=64 << 20, help='Socket receive buffer size')
+def main(endpoint, port, workers, dlen, interval, seconds, rcvbuf):
+    """Receive the streams sent by the boards, checking rates, sequence ids and sizes"""
+    from rich import print
+
+    bind = '0.0.0.0' if endpoint is None else socket.inet_ntoa(rx_endpoints[endpoint]['ip'].to_bytes(4, 'big'))
+
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=receive, args=(bind, port, dlen, interval, seconds, rcvbuf, results), daemon=True)
+        for _ in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    print(f"Receiving on {bind}:{hex(port)} with {workers} workers")
+
+    totals = StreamTotals()
+    running = workers
+    t_start = t_last = time.time()
+    try:
+        while running:
+            try:
+                d = results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if d is None:
+                running -= 1
+                continue
+            totals.merge(d)
+
+            now = time.time()
+            if now-t_last >= interval:
+                print(*totals.tables(now-t_last))
+                t_last = now
+    except KeyboardInterrupt:
+        # The workers got the interrupt too, collect their last counters
+        for p in procs:
+            p.join()
+        while True:
+            try:
+                d = results.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if d is not None:
+                totals.merge(d)
+
+    print(f"Totals over {time.time()-t_start:.1f}s")
+    print(*totals.tables(time.time()-t_last))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+import json
+import time
+import click
+import numpy as np
+
+from rich import print
+from rich.table import Table
+from rich.markup import escape
+
+SNAPSHOT_VERSION = 1
+
+# Register banks multiplexed behind a selector register.
+# (bank prefix, selector register, generic giving the number of banks)
+SELECTOR_BANKS = (
+    ('tx.mux', 'tx.csr.ctrl.sel', 'n_mgt'),
+    ('tx.mux.buf', 'tx.mux.csr.ctrl.sel_buf', 'n_srcs_p_mgt'),
+    ('src', 'ctrl.sel', 'n_src'),
+)
+
+# -----------------------------------------------------------------------------
+# Address table helpers
+def _in_bank(name, prefix):
+    return name == prefix or name.startswith(prefix+'.')
+
+
+def leaf_regs(addrtab):
+    """Return {name: (addr, mask)} for the leaf nodes of a flat address table"""
+    names = sorted(addrtab)
+    leaves = {}
+    for i, n in enumerate(names):
+        # names are sorted, so children immediately follow their parent
+        if i+1 < len(names) and names[i+1].startswith(n+'.'):
+            continue
+        leaves[n] = (int(addrtab[n]['addr'], 0), int(addrtab[n]['mask'], 0))
+    return leaves
+
+
+def address_ranges(addrs):
+    """Coalesce word addresses into contiguous (start, n_words) ranges"""
+    ranges = []
+    for a in sorted(set(addrs)):
+        if ranges and ranges[-1][0] + ranges[-1][1] == a:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([a, 1])
+    return [tuple(r) for r in ranges]
+
+
+def _mask_shift(mask):
+    return (mask & -mask).bit_length()-1
+
+
+# -----------------------------------------------------------------------------
+class SnapshotLayout:
+    """Read plan and word/field bookkeeping for a snapshot of the whole address space"""
+
+    def __init__(self, addrtab, counts):
+
+        leaves = leaf_regs(addrtab)
+        banks = [b for b in SELECTOR_BANKS if b[1] in addrtab]
+        self.selectors = [b[1] for b in banks]
+
+        # bank 0 is the unselected address space
+        self.banks = [{'prefix': '', 'selectors': []}]
+        bank_chain = {}
+        for prefix, sel, _ in banks:
+            outer = [b for b in banks if b[0] != prefix and _in_bank(prefix, b[0])]
+            bank_chain[prefix] = [b[1] for b in outer] + [sel]
+            self.banks.append({'prefix': prefix, 'selectors': bank_chain[prefix]})
+        self.depth = max([len(b['selectors']) for b in self.banks])
+
+        # Assign every leaf to the innermost bank containing it
+        bank_fields = [[] for _ in self.banks]
+        for n, (addr, mask) in leaves.items():
+            owners = [i for i, b in enumerate(self.banks) if i and _in_bank(n, b['prefix'])]
+            b = max(owners, key=lambda i: len(self.banks[i]['prefix'])) if owners else 0
+            bank_fields[b].append((n, addr, mask))
+
+        self.names = sorted(leaves)
+        name_idx = {n: i for i, n in enumerate(self.names)}
+
+        # Build the sequence of selector writes and block reads
+        self.steps = []
+        word_addr, word_bank, word_sel = [], [], []
+        f_word, f_mask, f_name = [], [], []
+
+        def add_bank(b, sel_vals):
+            by_addr = {}
+            for n, addr, mask in bank_fields[b]:
+                by_addr.setdefault(addr, []).append((n, mask))
+            for start, n in address_ranges(by_addr):
+                self.steps.append(('r', start, n))
+                for a in range(start, start+n):
+                    for fn, mask in by_addr[a]:
+                        f_word.append(len(word_addr))
+                        f_mask.append(mask)
+                        f_name.append(name_idx[fn])
+                    word_addr.append(a)
+                    word_bank.append(b)
+                    word_sel.append(sel_vals + [-1]*(self.depth-len(sel_vals)))
+
+        def add_nested(parent, sel_vals):
+            nested = [
+                (b, sel, count) for b, (prefix, sel, count) in enumerate(banks, 1)
+                if bank_chain[prefix][:-1] == self.banks[parent]['selectors']
+            ]
+            # Selectors inside a selected bank are saved, and put back
+            # before the outer selector moves to the next bank
+            if parent:
+                self.steps += [('s', sel, None) for _, sel, _ in nested]
+            for b, sel, count in nested:
+                for v in range(counts[count]):
+                    self.steps.append(('w', sel, v))
+                    add_bank(b, sel_vals + [v])
+                    add_nested(b, sel_vals + [v])
+            if parent:
+                self.steps += [('x', sel, None) for _, sel, _ in reversed(nested)]
+
+        add_bank(0, [])
+        add_nested(0, [])
+
+        self.addrs = np.array(word_addr, dtype=np.uint32)
+        self.word_bank = np.array(word_bank, dtype=np.uint8)
+        self.word_sel = np.array(word_sel, dtype=np.int16).reshape(len(word_addr), self.depth)
+        self.f_word = np.array(f_word, dtype=np.uint32)
+        self.f_mask = np.array(f_mask, dtype=np.uint32)
+        self.f_name = np.array(f_name, dtype=np.uint32)
+
+
+class Snapshot:
+    """Words read from the whole address space of a board, plus the layout to decode them"""
+
+    def __init__(self, meta, words, addrs, word_bank, word_sel, f_word, f_mask, f_name):
+        self.meta = meta
+        self.words = words
+        self.addrs = addrs
+        self.word_bank = word_bank
+        self.word_sel = word_sel
+        self.f_word = f_word
+        self.f_mask = f_mask
+        self.f_name = f_name
+        self.f_shift = np.array([_mask_shift(int(m)) for m in f_mask], dtype=np.uint32)
+
+    def label(self, field):
+        """Field name, qualified with the selector values of its bank"""
+        w = self.f_word[field]
+        name = self.meta['names'][self.f_name[field]]
+        sels = self.meta['banks'][self.word_bank[w]]['selectors']
+        if not sels:
+            return name
+        return name+'['+','.join(f"{s.rsplit('.', 1)[-1]}={v}" for s, v in zip(sels, self.word_sel[w]))+']'
+
+    def field_values(self, fields=None):
+        f = slice(None) if fields is None else fields
+        return (self.words[self.f_word[f]] & self.f_mask[f]) >> self.f_shift[f]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                meta=np.array(json.dumps(self.meta)),
+                words=self.words,
+                addrs=self.addrs,
+                word_bank=self.word_bank,
+                word_sel=self.word_sel,
+                f_word=self.f_word,
+                f_mask=self.f_mask,
+                f_name=self.f_name,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            meta = json.loads(str(z['meta']))
+            if meta.get('version') != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version {meta.get('version')} in {path}")
+            return cls(meta, *(z[k] for k in ('words', 'addrs', 'word_bank', 'word_sel', 'f_word', 'f_mask', 'f_name')))
+
+
+def take_snapshot(hw, **meta):
+    """Read the whole address space of a board through block reads"""
+
+    n_mgt = hw.read('tx.info.generics.n_mgts')
+    n_src = hw.read('tx.info.generics.n_srcs')
+    counts = {'n_mgt': n_mgt, 'n_src': n_src, 'n_srcs_p_mgt': n_src//n_mgt}
+
+    layout = SnapshotLayout(hw.addrtab, counts)
+
+    # Save the selectors, the snapshot has to leave the board as it found it
+    sel_orig = {s: hw.read(s) for s in layout.selectors}
+
+    t0 = time.time()
+    words = []
+    # Nested selectors of the bank being read
+    saved = []
+    try:
+        for step in layout.steps:
+            if step[0] == 'w':
+                hw.write(step[1], step[2])
+            elif step[0] == 's':
+                saved.append((step[1], hw.read(step[1])))
+            elif step[0] == 'x':
+                hw.write(*saved.pop())
+            else:
+                words += hw.read_block(step[1], step[2])
+    finally:
+        # Innermost first, while their bank is still selected
+        while saved:
+            hw.write(*saved.pop())
+        for s, v in sel_orig.items():
+            hw.write(s, v)
+    t1 = time.time()
+
+    versions = hw.read('tx.info.versions')
+    meta.update({
+        'version': SNAPSHOT_VERSION,
+        'time': t0,
+        'duration': t1-t0,
+        'firmware': '.'.join(str((versions >> s) & 0xff) for s in (24, 16, 8, 0)),
+        'counts': counts,
+        'banks': layout.banks,
+        'names': layout.names,
+    })
+
+    return Snapshot(
+        meta, np.array(words, dtype=np.uint32), layout.addrs, layout.word_bank, layout.word_sel,
+        layout.f_word, layout.f_mask, layout.f_name
+        )
+
+
+def diff_snapshots(a, b):
+    """Return [(label, old, new)] for the fields that differ between two snapshots"""
+
+    if (a.addrs.shape != b.addrs.shape or (a.addrs != b.addrs).any() or (a.word_sel != b.word_sel).any()
+        or a.meta['names'] != b.meta['names']):
+        raise ValueError("Snapshots have different layouts and cannot be compared")
+
+    # Only fields in words that changed are decoded
+    changed_words = a.words != b.words
+    fields = np.flatnonzero(changed_words[a.f_word])
+    va = a.field_values(fields)
+    vb = b.field_values(fields)
+    fields = fields[va != vb]
+
+    return [(a.label(f), int(o), int(n)) for f, o, n in zip(fields, a.field_values(fields), b.field_values(fields))]
+
+
+# -----------------------------------------------------------------------------
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument('snapshot', type=click.Path(exists=True))
+def info(snapshot):
+    """Summary of a snapshot file"""
+    s = Snapshot.load(snapshot)
+    t = Table(title=snapshot)
+    t.add_column('name')
+    t.add_column('value', style='green')
+    for k in ('host', 'firmware', 'time', 'duration', 'counts'):
+        t.add_row(k, str(s.meta.get(k)))
+    t.add_row('words', str(len(s.words)))
+    t.add_row('fields', str(len(s.f_word)))
+    print(t)
+
+
+@main.command()
+@click.argument('snapshot_a', type=click.Path(exists=True))
+@click.argument('snapshot_b', type=click.Path(exists=True))
+def diff(snapshot_a, snapshot_b):
+    """Fields that differ between two snapshots"""
+    a = Snapshot.load(snapshot_a)
+    b = Snapshot.load(snapshot_b)
+
+    if a.meta['firmware'] != b.meta['firmware']:
+        print(f"[yellow]Firmware versions differ: {a.meta['firmware']} vs {b.meta['firmware']}[/yellow]")
+
+    t = Table(title=f"{a.meta.get('host')} vs {b.meta.get('host')}")
+    t.add_column('name')
+    t.add_column(snapshot_a, style='green')
+    t.add_column(snapshot_b, style='cyan')
+    for n, o, v in diff_snapshots(a, b):
+        t.add_row(escape(n), hex(o), hex(v))
+    print(t)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,13 @@ import json
 import time
 import sys, subprocess
 import click
-import rich
 import logging
 import os
 
-from rich import print
-from rich.table import Table
-from rich.logging import RichHandler
-from rich.progress import track
+from crappyfmt import FORMATS, RecordWriter
 
-from crappyhalclient import CrappyHardwareClient
+# rich and the hardware client are imported where needed, keeping the
+# start-up of the command line short
 
 
 MAX_MGT=2
@@ -22,7 +19,12 @@ MAX_MGT=2
 
 # -----------------------------------------------------------------------------
 # Utilities
+def print(*args, **kwargs):
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
 def dict_to_table( vals: dict, **kwargs):
+    from rich.table import Table
 
     t = Table(**kwargs)
     t.add_column('name')
@@ -32,8 +34,9 @@ def dict_to_table( vals: dict, **kwargs):
     return t
 
 def read_regs(hw, reg_list):
+    # Values split over two registers are read at once, consistently
     d = {}
-    for r in reg_list:
+    for r in hw.merge_wide(reg_list):
         v = hw.read(r)
         d[r] = v
     return d
@@ -54,18 +57,20 @@ ctrl_hosts = [
 
 port = 5556
 # addrtab = 'zcu_top.flat_regmap.json'
-addrtab = os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', 'hermes_zcu_mark3', 'zcu_top.xml')
+def addrtab_path():
+    return os.path.join(os.environ['CRAPPYZCU_SHARE'], 'config', 'hermes_zcu_mark3', 'zcu_top.xml')
 
 mgts_all = tuple(str(i) for i in range(MAX_MGT))
 
 @click.command()
 @click.argument('ctrl_id', type=click.Choice(ctrl_hosts))
 @click.option('-m', '--mgts', 'sel_mgts', type=click.Choice(mgts_all), multiple=True, default=None)
-def main(ctrl_id, sel_mgts):
+@click.option('-f', '--format', 'fmt', type=click.Choice(FORMATS), default='table', help='Output format, jsonl and csv stream one record per register')
+def main(ctrl_id, sel_mgts, fmt):
     """Simple program that greets NAME for a total of COUNT times."""
+    from crappyhalclient import CrappyHardwareClient
 
-
-    hw = CrappyHardwareClient(ctrl_id, port, addrtab)
+    hw = CrappyHardwareClient(ctrl_id, port, addrtab_path())
     hw.connect()
 
     magic = hw.read('tx.info.magic')
@@ -105,6 +110,12 @@ def main(ctrl_id, sel_mgts):
     time.sleep(1)
     hw.write('tx.mux.csr.ctrl.sample', False)
 
+    if fmt != 'table':
+        stream_stats(hw, ctrl_id, fmt, sel_mgts, n_src//n_mgt)
+        return
+
+    from rich.table import Table
+    from rich.progress import track
 
     # print('---Reading info regs---')
     ctrl_i =read_regs(hw, hw.get_regs('tx.info.*'))
@@ -173,8 +184,28 @@ def main(ctrl_id, sel_mgts):
         print(t)
         
 
+def stream_stats(hw, ctrl_id, fmt, sel_mgts, n_srcs_p_mgt):
+    """Same registers as the tables, written as records as soon as they are read"""
+    out = RecordWriter(fmt, host=ctrl_id)
+
+    out.write(read_regs(hw, hw.get_regs('tx.info.*')))
+    out.write(read_regs(hw, hw.get_regs('tx.mux.csr.ctrl.*')))
+    out.write(read_regs(hw, hw.get_regs('tx.mux.csr.stat.*')))
+
+    for i in sel_mgts:
+        hw.write('tx.mux.csr.ctrl.sel_mux',i)
+        out.write(read_regs(hw, hw.get_regs('tx.mux.mux.stat.*')), link=i)
+        out.write(read_regs(hw, hw.get_regs(f'tx.udp.udp_core_{i}.udp_core_control.packet_counters.*')), link=i)
+        out.write(read_regs(hw, hw.get_regs(f'tx.udp.udp_core_{i}.udp_core_control.nz_rst_ctrl.(filter_control|src|dst|udp).*')), link=i)
+
+        for j in range(n_srcs_p_mgt*i, n_srcs_p_mgt*(i+1)):
+            hw.write('tx.mux.csr.ctrl.sel_buf',j)
+            out.write(read_regs(hw, hw.get_regs('tx.mux.buf.*')), link=i, buf=j)
+
 
 if __name__ == '__main__':
+    from rich.logging import RichHandler
+
     FORMAT = "%(message)s"
     logging.basicConfig(
         level="WARN", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
@@ -0,0 +1,181 @@
+import csv
+import itertools
+import time
+
+from crappyrcvr import HEADER_BYTES, DLEN_BYTES
+
+# Generators a sweep configures, as 'fakesrc-config' and 'zcu-src-config' do
+SOURCE_KINDS = ('fake', 'zcu')
+
+# Buffer counters sampled at each point
+BUF_COUNTERS = ('tx.mux.buf.blk_acc', 'tx.mux.buf.vol', 'tx.mux.buf.blk_rej', 'tx.mux.buf.blk_oflow')
+
+FIELDS = (
+    'link', 'n_src', 'dlen', 'rate_rdx', 'pkt_rate', 'byte_rate', 'vol_rate',
+    'rejected', 'overflowed', 'mux_oflow', 'hwm', 'drop_free',
+)
+
+
+class LinkSweep:
+    """Source settings of one link, and the counters measuring them"""
+
+    def __init__(self, hw, kind, link, n_srcs_p_mgt):
+        self.hw = hw
+        self.kind = kind
+        self.link = link
+        self.n_srcs_p_mgt = n_srcs_p_mgt
+        self._saved = None
+        self._sample = None
+        self._oflow_pos = None
+        self._buf_pos = None
+
+    def _select_link(self):
+        return self.hw.node('tx.csr.ctrl').write_ops({'sel': self.link})
+
+    def _select_src(self, i):
+        if self.kind == 'fake':
+            return self.hw.node('tx.mux.csr.ctrl').write_ops({'sel_buf': i})
+        return self.hw.node('ctrl').write_ops({'sel': self.n_srcs_p_mgt*self.link+i})
+
+    @property
+    def _src_ctrl(self):
+        return 'tx.mux.buf.ctrl' if self.kind == 'fake' else 'src.ctrl'
+
+    def _word(self, name):
+        n = self.hw.addrtab[name]
+        return int(n['addr'], 0), int(n['mask'], 0)
+
+    def save(self):
+        """Read the link and source control words, in one batch"""
+        ops = self._select_link()+[['read', *self._word('tx.mux.csr.ctrl'), 0]]
+        for i in range(self.n_srcs_p_mgt):
+            ops += self._select_src(i)+[['read', *self._word(self._src_ctrl), 0]]
+        vals = self.hw.batch(ops)
+        # The link control word, then the control word of each source
+        self._saved = [v for op, v in zip(ops, vals) if op[0] == 'read']
+
+    def restore(self):
+        """Write back the words read by save(), buffers enabled last"""
+        mux_ctrl, srcs = self._saved[0], self._saved[1:]
+        ops = self._select_link()+self.hw.node('tx.mux.csr.ctrl').write_ops({'en_buf': 0})
+        for i, v in enumerate(srcs):
+            ops += self._select_src(i)+[['write', *self._word(self._src_ctrl), v]]
+        ops += [['write', *self._word('tx.mux.csr.ctrl'), mux_ctrl]]
+        self.hw.batch(ops)
+
+    def configure(self, n_src, dlen, rate_rdx):
+        """Enable the first 'n_src' sources with 'dlen' and 'rate_rdx', in one batch"""
+        mux = self.hw.node('tx.mux.csr.ctrl')
+        ctrl = self.hw.node(self._src_ctrl)
+        en = 'fake_en' if self.kind == 'fake' else 'en'
+
+        # Buffers are disabled while reconfiguring the sources
+        ops = self._select_link()+mux.write_ops({'en_buf': 0})
+        for i in range(self.n_srcs_p_mgt):
+            ops += self._select_src(i)
+            ops += ctrl.write_ops({en: i < n_src, 'dlen': dlen, 'rate_rdx': rate_rdx})
+        ops += mux.write_ops({'en_buf': 1})
+        self.hw.batch(ops)
+
+    def sample(self):
+        """Latch the counters through the sampling gate and read them, in one request
+
+        Returns (time, mux overflow, [(acc, vol, rej, oflow, hwm) per buffer]).
+        """
+        hw = self.hw
+        names = [*BUF_COUNTERS, 'tx.mux.buf.buf_mon.hwm']
+        if self._sample is None:
+            samp = hw.node('tx.samp.ctrl')
+            ops = self._select_link()+samp.write_ops({'samp': 1})+samp.write_ops({'samp': 0})
+            self._oflow_pos = len(ops)
+            ops += hw.read_ops(['tx.mux.mux.stat.oflow'])
+            self._buf_pos = []
+            for i in range(self.n_srcs_p_mgt):
+                ops += hw.node('tx.mux.csr.ctrl').write_ops({'sel_buf': i})
+                self._buf_pos.append(len(ops))
+                ops += hw.read_ops(names)
+            self._sample = hw.prepare(ops)
+
+        t0 = time.time()
+        vals = self._sample.execute()
+        t = (t0+time.time())/2
+
+        bufs = [list(hw.read_vals(names, vals[p:p+len(names)]).values()) for p in self._buf_pos]
+        return t, vals[self._oflow_pos], bufs
+
+    def measure(self, n_src, dlen, rate_rdx, settle, window):
+        """Configure a point, and measure the rates over 'window' seconds"""
+        self.configure(n_src, dlen, rate_rdx)
+        time.sleep(settle)
+
+        t0, _, b0 = self.sample()
+        time.sleep(window)
+        t1, mux_oflow, b1 = self.sample()
+
+        dt = t1-t0
+        d = [[hi-lo for lo, hi in zip(x0[:4], x1[:4])] for x0, x1 in zip(b0, b1)]
+        acc, vol, rej, oflow = (sum(x[k] for x in d) for k in range(4))
+        return {
+            'link': self.link,
+            'n_src': n_src,
+            'dlen': dlen,
+            'rate_rdx': rate_rdx,
+            'pkt_rate': acc/dt,
+            'byte_rate': acc*(HEADER_BYTES+dlen*DLEN_BYTES)/dt,
+            'vol_rate': vol/dt,
+            'rejected': rej,
+            'overflowed': oflow,
+            'mux_oflow': mux_oflow,
+            'hwm': max(x[4] for x in b1),
+            'drop_free': rej == 0 and oflow == 0 and not mux_oflow,
+        }
+
+
+def sweep(hw, kind, links, n_srcs_p_mgt, n_srcs, dlens, rate_rdxs, settle, window, progress=None):
+    """Measure every (n_src, dlen, rate_rdx) point on each link, then restore the configuration
+
+    'progress' wraps the iteration over the points, e.g. rich's track.
+    """
+    sel = hw.read('tx.csr.ctrl')
+    sel_src = hw.read('ctrl') if kind == 'zcu' else None
+    sweeps = [LinkSweep(hw, kind, l, n_srcs_p_mgt) for l in links]
+
+    points = list(itertools.product(sweeps, n_srcs, dlens, rate_rdxs))
+    if progress is not None:
+        points = progress(points)
+
+    results = []
+    try:
+        for s in sweeps:
+            s.save()
+        for s, n_src, dlen, rate_rdx in points:
+            results.append(s.measure(n_src, dlen, rate_rdx, settle, window))
+    finally:
+        for s in sweeps:
+            if s._saved is not None:
+                s.restore()
+        hw.write('tx.csr.ctrl', sel)
+        if sel_src is not None:
+            hw.write('ctrl', sel_src)
+    return results
+
+
+def best_points(results):
+    """Highest drop-free byte rate point of each link, {link: point}"""
+    best = {}
+    for r in results:
+        if not r['drop_free'] or not r['pkt_rate']:
+            continue
+        b = best.get(r['link'])
+        if b is None or r['byte_rate'] > b['byte_rate']:
+            best[r['link']] = r
+    return best
+
+
+def save_results(path, host, results):
+    best = best_points(results)
+    with open(path, 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=('host', *FIELDS, 'best'))
+        w.writeheader()
+        for r in results:
+            w.writerow({'host': host, **r, 'best': best.get(r['link']) is r})
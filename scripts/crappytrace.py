@@ -0,0 +1,76 @@
+import re
+import struct
+
+# Trace file: header followed by one fixed size record per operation
+TRACE_MAGIC = b'CRTR'
+TRACE_VERSION = 1
+_HEADER = struct.Struct('<4sHI')
+_RECORD = struct.Struct('<BIII')
+
+OPCODES = {'read': 0, 'write': 1, 'read_block': 2, 'wait': 3, 'read_wide': 4}
+_OPNAMES = {v: k for k, v in OPCODES.items()}
+
+
+class CrappyVerifyError(Exception):
+    "Register read back after a replayed write does not hold the written value"
+    pass
+
+
+def save_trace(path, ops):
+    """Write a list of [cmd, addr, mask, val] operations to a trace file"""
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, len(ops)))
+        for cmd, addr, mask, val in ops:
+            f.write(_RECORD.pack(OPCODES[cmd], addr, mask, val))
+
+
+def load_trace(path):
+    """Read the [cmd, addr, mask, val] operations stored in a trace file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, n = _HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError(f"{path} is not a version {TRACE_VERSION} trace file")
+    if len(data) != _HEADER.size + n*_RECORD.size:
+        raise ValueError(f"{path} is truncated")
+
+    return [[_OPNAMES[c], a, m, v] for c, a, m, v in _RECORD.iter_unpack(data[_HEADER.size:])]
+
+
+def replay_trace(hw, ops, verify=None):
+    """Send a recorded operation stream to the hardware
+
+    The operations are replayed verbatim: values read while recording (e.g. a
+    buffer enable saved and restored around a reconfiguration) are not
+    re-evaluated. Writes to registers matching the 'verify' regex are followed
+    by a read back, checked against the written value.
+
+    Returns the number of writes verified.
+    """
+
+    checked = set()
+    if verify:
+        exp = re.compile(verify)
+        checked = {
+            (int(d['addr'], 0), int(d['mask'], 0)): n for n, d in hw.addrtab.items() if exp.match(n)
+        }
+
+    # The read back must follow the write to see the same selector settings
+    stream = []
+    expected = []
+    for op in ops:
+        stream.append(op)
+        cmd, addr, mask, val = op
+        if cmd == 'write' and (addr, mask) in checked:
+            s = (mask & -mask).bit_length()-1
+            expected.append((len(stream), checked[(addr, mask)], val & (mask >> s)))
+            stream.append(['read', addr, mask, 0])
+
+    vals = hw.batch(stream)
+
+    for i, name, val in expected:
+        if vals[i] != val:
+            raise CrappyVerifyError(f"{name}: wrote {hex(val)}, read back {hex(vals[i])}")
+
+    return len(expected)
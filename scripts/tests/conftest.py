@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tools are flat modules in scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,25 @@
+from crappyflight import FlightRecorder
+
+
+def fill(fr, n):
+    for i in range(n):
+        fr.record(0, 1, i, 0xffffffff, i, 1.)
+
+
+def test_full_recorder():
+    fr = FlightRecorder(8)
+    fill(fr, 8)
+    assert [r[3] for r in fr.records()] == list(range(8))
+
+
+def test_wrapped_recorder():
+    fr = FlightRecorder(8)
+    fill(fr, 11)
+    assert [r[3] for r in fr.records()] == list(range(3, 11))
+    assert [r[3] for r in fr.records(2)] == [9, 10]
+
+
+def test_partial_recorder():
+    fr = FlightRecorder(8)
+    fill(fr, 3)
+    assert [r[3] for r in fr.records()] == [0, 1, 2]
@@ -0,0 +1,92 @@
+import pytest
+
+# The server maps the hardware through devmem, only installed on the boards
+pytest.importorskip('devmem')
+
+from crappyhal_srv import CrappyHalServer
+
+
+class FakeHardware:
+    """Words equal to their address, block reads are logged"""
+
+    def __init__(self):
+        self.blocks = []
+
+    def read_block(self, addr, n):
+        self.blocks.append((addr, n))
+        return list(range(addr, addr+n))
+
+    def read_addr(self, addr, mask):
+        return addr & mask
+
+    def write_addr(self, addr, mask, val):
+        val & mask
+
+
+def prepare_reads(addrs, gap=None):
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    req = {'cmd': 'prepare', 'ops': [['read', a, 0xffffffff, 0] for a in addrs]}
+    if gap is not None:
+        req['gap'] = gap
+    handle = srv.handle(req)['handle']
+    vals = srv.handle({'cmd': 'execute', 'handle': handle})['batch_vals']
+    return srv.hw.blocks, vals
+
+
+def test_prepare_contiguous_only():
+    blocks, vals = prepare_reads([0x12, 0x10, 0x11, 0x14])
+    assert blocks == [(0x10, 3), (0x14, 1)]
+    assert vals == [0x12, 0x10, 0x11, 0x14]
+
+
+def test_prepare_gap_opt_in():
+    blocks, vals = prepare_reads([0x12, 0x10, 0x11, 0x14, 0x20], gap=1)
+    assert blocks == [(0x10, 5), (0x20, 1)]
+    assert vals == [0x12, 0x10, 0x11, 0x14, 0x20]
+
+
+def test_prepare_invalid_gap():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    assert srv.handle({'cmd': 'prepare', 'ops': [], 'gap': -1}) == {'error': 'InvalidGap'}
+
+
+def test_batch_malformed_ops():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    for ops in (5, [5], ['read'], [{'cmd': 'read'}]):
+        assert srv.handle({'cmd': 'batch', 'ops': ops}) == {'error': 'InvalidOperation', 'batch_vals': []}
+
+
+def test_execute_invalid_handle():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    for handle in (None, 5, ['a'], {'a': 1}):
+        assert srv.handle({'cmd': 'execute', 'handle': handle}) == {'error': 'InvalidHandle'}
+    handle = srv.handle({'cmd': 'prepare', 'ops': [['read', 0x10, 0xffffffff, 0]]})['handle']
+    assert srv.handle({'cmd': 'execute', 'handle': handle, 'version': [1]}) == {'error': 'InvalidVersion'}
+    assert srv.handle({'cmd': 'execute', 'handle': handle, 'version': None})['batch_vals'] == [0x10]
+    assert srv.handle({'cmd': 'prepare', 'ops': 5}) == {'error': 'InvalidOperation'}
+
+
+def test_invalid_rid():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    for rid in ('1', [1], {'a': 1}):
+        assert srv.handle({'cmd': 'caps', 'rid': rid}) == {'error': 'InvalidRid'}
+    assert 'caps' in srv.handle({'cmd': 'caps', 'rid': 1})
+
+
+def test_invalid_single_ops():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    assert srv.handle({'cmd': 'read', 'addr': '0x10'}) == {'error': 'InvalidAddress'}
+    assert srv.handle({'cmd': 'read', 'addr': 0x50000}) == {'error': 'InvalidAddress'}
+    assert srv.handle({'cmd': 'write', 'addr': 0x10}) == {'error': 'InvalidOperation'}
+    assert srv.handle({'cmd': 'read_block', 'addr': 0x10, 'n': 'x'}) == {'error': 'InvalidOperation'}
+    assert srv.handle({'cmd': 'read', 'addr': 0x10}) == {'read_val': '0x10'}
+
+
+def test_flightrec_count():
+    srv = CrappyHalServer(FakeHardware(), log_every=0)
+    srv.handle({'cmd': 'read', 'addr': 0x10})
+    srv.handle({'cmd': 'read', 'addr': 0x11})
+    for n in ('x', -1, [1]):
+        assert srv.handle({'cmd': 'flightrec', 'n': n}) == {'error': 'InvalidCount'}
+    assert [r[3] for r in srv.handle({'cmd': 'flightrec', 'n': 1})['flightrec']] == [0x11]
+    assert len(srv.handle({'cmd': 'flightrec'})['flightrec']) == 2
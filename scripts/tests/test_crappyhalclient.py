@@ -0,0 +1,97 @@
+import collections
+import socket
+
+import pytest
+
+from crappyhalclient import CrappyHardwareClient, CrappyPrepared, CrappyServerError, select_transport
+from crappytrace import OPCODES
+
+
+def hw_with(addrtab):
+    # Only the address table is needed, no connection nor uhal
+    hw = CrappyHardwareClient.__new__(CrappyHardwareClient)
+    hw._addrtab = collections.OrderedDict((n, {'addr': hex(a), 'mask': hex(m)}) for n, a, m in addrtab)
+    hw._wide = None
+    hw._trace = None
+    hw.socket = None
+    return hw
+
+
+def test_merge_wide_sorted_names():
+    hw = hw_with([
+        ('tx.mux.buf.blk_acc_h', 0x77, 0xffffffff),
+        ('tx.mux.buf.blk_acc_l', 0x76, 0xffffffff),
+        ('tx.mux.buf.buf_mon', 0x71, 0xffffffff),
+        ('tx.mux.buf.vol_h', 0x75, 0xffffffff),
+        ('tx.mux.buf.vol_l', 0x74, 0xffffffff),
+    ])
+    names = sorted(hw._addrtab)
+    assert hw.merge_wide(names) == ['tx.mux.buf.blk_acc', 'tx.mux.buf.buf_mon', 'tx.mux.buf.vol']
+
+
+def test_merge_wide_upper_bitfield():
+    hw = hw_with([
+        ('nz_rst_ctrl.src_mac_addr_lower', 0x200, 0xffffffff),
+        ('nz_rst_ctrl.src_mac_addr_upper', 0x201, 0xffffffff),
+        ('nz_rst_ctrl.src_mac_addr_upper.upper', 0x201, 0xffff),
+    ])
+    assert hw.merge_wide(sorted(hw._addrtab)) == ['nz_rst_ctrl.src_mac_addr']
+
+
+def test_merge_wide_lone_high_register():
+    hw = hw_with([
+        ('tx.samp.samp_ts_h', 0xb, 0xffffffff),
+        ('tx.samp.samp_ts_l', 0xa, 0xffffffff),
+    ])
+    assert hw.merge_wide(['tx.samp.samp_ts_h']) == ['tx.samp.samp_ts_h']
+
+
+def test_execute_idempotent():
+    hw = hw_with([])
+    hw._prepared = {}
+    for handle, ops in enumerate([
+        [['read', 0x76, 0xffffffff, 0]],
+        [['write', 0x76, 0xffffffff, 1]],
+        [[OPCODES['write'], 3, 1]],
+    ]):
+        p = CrappyPrepared(hw, ops)
+        p.handle = handle
+        hw._prepared[handle] = p
+
+    assert hw._is_idempotent({'cmd': 'execute', 'handle': 0})
+    assert not hw._is_idempotent({'cmd': 'execute', 'handle': 1})
+    assert not hw._is_idempotent({'cmd': 'execute', 'handle': 2})
+    # Not prepared by this client, its operations are unknown
+    assert not hw._is_idempotent({'cmd': 'execute', 'handle': 3})
+
+
+def test_read_wide_recorded_once():
+    hw = hw_with([])
+    # An older server, the wide read falls back to a batch
+    hw._caps = {'batch'}
+    hw._send_ops = lambda cmd, ops, timeout=None, deadline=None: {'batch_vals': [2, 1, 2]}
+    hw.start_recording()
+    assert hw.read_wide(0x76, 0x77) == [1, 2]
+    assert hw.stop_recording() == [['read_wide', 0x76, 0xffffffff, 0x77]]
+
+
+def test_batch_rejected_as_a_whole():
+    hw = hw_with([])
+    hw._caps = {'batch'}
+    hw._send_ops = lambda cmd, ops, timeout=None, deadline=None: {'error': 'InvalidBatchSize'}
+    with pytest.raises(CrappyServerError, match='InvalidBatchSize'):
+        hw.batch([['read', 0x76, 0xffffffff, 0]])
+
+
+def test_select_transport_prefers_running_server(tmp_path):
+    path = str(tmp_path/'crappyhal.sock')
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(path)
+    srv.listen()
+    try:
+        assert select_transport('localhost', path) == 'ipc'
+    finally:
+        srv.close()
+    # Left behind by a server that exited
+    assert select_transport('localhost', path) != 'ipc'
+    assert select_transport('np04-wib-999.invalid', path) == 'tcp'
@@ -0,0 +1,37 @@
+import numpy as np
+
+from crappyrcvr import HEADER_BYTES, SEQ_SHIFT, StreamStats
+
+
+def batch(seqs, key=0x40):
+    buf = np.zeros((len(seqs), HEADER_BYTES), dtype=np.uint8)
+    buf.view('<u8')[:, 0] = [key | (q << SEQ_SHIFT) for q in seqs]
+    return buf, np.full(len(seqs), HEADER_BYTES, dtype=np.int64)
+
+
+def test_in_order_gaps():
+    stats = StreamStats()
+    stats.add_batch(*batch([1, 2, 4, 5]))
+    stats.add_batch(*batch([8]))
+    assert stats.take()['sources'][0x40][:4] == [5, 5*HEADER_BYTES, 3, 0]
+
+
+def test_reordered_not_lost():
+    stats = StreamStats()
+    stats.add_batch(*batch([1, 3, 2, 4]))
+    assert stats.take()['sources'][0x40][2:4] == [1, 1]
+
+
+def test_reordered_across_batches():
+    stats = StreamStats()
+    stats.add_batch(*batch([1, 3, 2]))
+    stats.add_batch(*batch([4, 5]))
+    c = stats.take()['sources'][0x40]
+    assert c[2:4] == [1, 1]
+    assert stats.last_seq[0x40] == 5
+
+
+def test_sequence_wraps():
+    stats = StreamStats()
+    stats.add_batch(*batch([4094, 4095, 0, 1]))
+    assert stats.take()['sources'][0x40][2:4] == [0, 0]
@@ -0,0 +1,46 @@
+from crappysnap import take_snapshot
+
+ADDRTAB = {
+    'tx.info.generics.n_mgts': {'addr': '0x0', 'mask': '0xff'},
+    'tx.info.generics.n_srcs': {'addr': '0x0', 'mask': '0xff00'},
+    'tx.info.versions': {'addr': '0x1', 'mask': '0xffffffff'},
+    'tx.csr.ctrl.sel': {'addr': '0x2', 'mask': '0xff'},
+    'tx.mux.csr.ctrl.sel_buf': {'addr': '0x10', 'mask': '0xff'},
+    'tx.mux.buf.ctrl': {'addr': '0x20', 'mask': '0xffffffff'},
+}
+
+
+class FakeBoard:
+    """Two links of two buffers, each link with its own buffer selector"""
+
+    addrtab = ADDRTAB
+
+    def __init__(self, link, sel_buf):
+        self.link = link
+        self.sel_buf = sel_buf
+
+    def read(self, name):
+        return {
+            'tx.info.generics.n_mgts': 2,
+            'tx.info.generics.n_srcs': 4,
+            'tx.info.versions': 0,
+            'tx.csr.ctrl.sel': self.link,
+            'tx.mux.csr.ctrl.sel_buf': self.sel_buf[self.link],
+        }[name]
+
+    def write(self, name, val):
+        if name == 'tx.csr.ctrl.sel':
+            self.link = val
+        else:
+            self.sel_buf[self.link] = val
+
+    def read_block(self, addr, n):
+        return [0]*n
+
+
+def test_snapshot_restores_nested_selectors():
+    hw = FakeBoard(1, {0: 0, 1: 1})
+    s = take_snapshot(hw)
+    assert hw.link == 1
+    assert hw.sel_buf == {0: 0, 1: 1}
+    assert len(s.words) == len(s.addrs)
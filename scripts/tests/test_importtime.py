@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+from crappyimporttime import BUDGETS, HEAVY, import_time
+
+# Same as crappyimporttime --scale, for slow machines
+SCALE = float(os.environ.get('CRAPPYIMPORTTIME_SCALE', 1))
+
+
+@pytest.mark.parametrize('module', sorted(BUDGETS))
+def test_import_time(module):
+    times = import_time(module)
+    heavy = sorted(m for m in times if m.split('.')[0] in HEAVY)
+    assert not heavy, f"{module} loads {', '.join(heavy)}"
+    ms = times[module]/1e3
+    assert ms <= BUDGETS[module]*SCALE, f"{module}: {ms:.1f} ms over its {BUDGETS[module]} ms budget"